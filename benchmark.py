@@ -0,0 +1,595 @@
+"""Benchmark offline del bot: nessuna richiesta a Vinted o Telegram.
+
+Uso:
+    python benchmark.py parse [pagina.html ...] [--repeat N]
+    python benchmark.py price [--repeat N]
+    python benchmark.py cards [--repeat N]
+    python benchmark.py load [--users N] [--links M] [--duration S] [--variant json|html|mixed] ...
+
+Senza file usa pagine catalogo sintetiche (con JSON embedded e solo HTML).
+"load" avvia in un processo separato un catalogo Vinted finto (latenza e
+articoli nuovi configurabili) e una Bot API Telegram finta, poi fa girare
+scheduler, check e notifiche del bot e misura check/s, latenza di
+rilevamento, CPU e memoria.
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import asyncio
+import logging
+import re
+import argparse
+import statistics
+
+# Niente database su disco e niente log per ogni articolo
+os.environ.setdefault('DB_FILE', ':memory:')
+logging.disable(logging.WARNING)
+
+import bot
+from tests.corpus import PRICE_GOLDEN, legacy_extract_price
+
+TITLES = [
+    'Nintendo Switch Lite turchese', 'Felpa Nike vintage taglia M', 'Giacca di pelle nera',
+    'Scarpe Adidas Samba 42', 'Borsa Michael Kors originale', 'Jeans Levi\'s 501 W32',
+    'Maglione di lana fatto a mano', 'Vestito estivo a fiori', 'Cappotto Zara beige',
+]
+
+
+def make_items(count, start_id=4000000000, seed=0):
+    rnd = random.Random(seed)
+    items = []
+    for i in range(count):
+        price = rnd.randint(3, 400) + rnd.choice([0, 0.5, 0.99])
+        items.append({
+            'id': start_id + i,
+            'title': f"{rnd.choice(TITLES)} #{i}",
+            'price': f"{price:.2f}",
+            'total_item_price': f"{price * 1.05 + 0.7:.2f}",
+            'currency': 'EUR',
+            'url': f"https://www.vinted.it/items/{start_id + i}-articolo",
+            'photo': {'url': f"https://images1.vinted.net/t/{start_id + i}/f800/foto.jpeg"},
+            'brand_title': 'Marca', 'size_title': 'M', 'status': 'Ottime',
+            'user': {'id': rnd.randint(1, 10 ** 8), 'login': 'utente', 'photo': None},
+        })
+    return items
+
+
+def _item_card(item):
+    price = item['price'].replace('.', ',')
+    total = item['total_item_price'].replace('.', ',')
+    return (
+        '<div class="feed-grid__item"><div class="new-item-box__container" data-testid="grid-item">'
+        '<div class="new-item-box__image-container">'
+        f'<a href="/items/{item["id"]}-articolo" class="new-item-box__overlay" '
+        f'title="{item["title"]}, condizioni: Ottime, {price} €, {total} € include la Protezione acquisti"></a>'
+        f'<img src="{item["photo"]["url"]}" alt="{item["title"]}"></div>'
+        '<div class="new-item-box__summary">'
+        '<p class="web_ui__Text__caption">Marca</p><p class="web_ui__Text__caption">M · Ottime</p>'
+        f'<p class="web_ui__Text__caption" data-testid="grid-item--price-text">{price} €</p>'
+        f'<span class="web_ui__Text__subtitle">{total} € include la Protezione acquisti</span>'
+        '</div></div></div>'
+    )
+
+
+def make_catalog_page(count=96, embedded_json=True, start_id=4000000000, seed=0):
+    """Pagina catalogo sintetica con la struttura di quelle vere"""
+    return render_catalog_page(make_items(count, start_id, seed), embedded_json)
+
+
+def render_catalog_page(items, embedded_json=True):
+    count = len(items)
+    nav = ''.join(f'<li><a href="/catalog/{i}-categoria">Categoria {i}</a></li>' for i in range(300))
+    head_scripts = ''.join(f'<script>window.__cfg{i} = {{"a": {i}, "b": "{"x" * 200}"}};</script>' for i in range(20))
+    state = ''
+    if embedded_json:
+        payload = {
+            'session': {'user': None, 'locale': 'it-IT'},
+            'catalog': {'filters': {'search_text': 'x', 'catalog': list(range(50))},
+                        'items': {'ids': [it['id'] for it in items]}},
+            'layout': {'menu': [{'id': i, 'title': f'Voce {i}', 'children': list(range(10))} for i in range(80)]},
+            'search': {'items': items, 'pagination': {'page': 1, 'per_page': count}},
+        }
+        state = f'<script>window.__INITIAL_STATE__ = {json.dumps(payload)};</script>'
+    cards = ''.join(_item_card(it) for it in items)
+    return (
+        f'<!DOCTYPE html><html lang="it"><head><title>Vinted</title>{head_scripts}</head><body>'
+        f'<header><nav><ul>{nav}</ul></nav></header>'
+        f'<main><div class="feed-grid">{cards}</div></main>'
+        f'<footer>{"<p>Informazioni legali</p>" * 50}</footer>{state}</body></html>'
+    )
+
+
+def render_catalog_api(items):
+    """Risposta di /api/v2/catalog/items con gli stessi articoli della pagina"""
+    def money(amount, item):
+        return {'amount': amount, 'currency_code': item['currency']}
+    api_items = [dict(it, price=money(it['price'], it), total_item_price=money(it['total_item_price'], it))
+                 for it in items]
+    return json.dumps({
+        'items': api_items,
+        'dominant_brand': None,
+        'search_tracking_params': {'search_correlation_id': 'bench', 'search_session_id': 'bench'},
+        'pagination': {'current_page': 1, 'total_pages': 1, 'total_entries': len(items),
+                       'per_page': len(items), 'time': int(time.time())},
+        'code': 0,
+    })
+
+
+def _timeit(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+    return statistics.median(times) * 1000
+
+
+def bench_parse(args):
+    pages = []
+    for path in args.pages:
+        with open(path, 'rb') as f:
+            pages.append((os.path.basename(path), f.read().decode('utf-8', 'replace')))
+    if not pages:
+        pages = [
+            ('sintetica-json', make_catalog_page(embedded_json=True)),
+            ('sintetica-html', make_catalog_page(embedded_json=False)),
+        ]
+    backends = ['html.parser'] + (['lxml'] if bot.lxml_html is not None else [])
+
+    print(f"{'pagina':<24}{'KB':>8}" + ''.join(f'{b:>16}' for b in backends) + '  articoli')
+    for name, html in pages:
+        results = {}
+        row = f"{name:<24}{len(html) / 1024:>8.0f}"
+        for backend in backends:
+            parser = bot.CatalogParser(backend)
+            results[backend] = parser.parse(html)
+            row += f"{_timeit(lambda: parser.parse(html), args.repeat):>13.2f} ms"
+        same = all(r == results[backends[0]] for r in results.values())
+        row += f"  {len(results[backends[0]])}{'' if same else '  ⚠️ risultati diversi tra backend'}"
+        print(row)
+
+    if not args.pages:
+        # Stessi articoli dall'endpoint JSON (FETCH_MODE=api): un solo parser per tutti i backend
+        items = make_items(96)
+        body = render_catalog_api(items[:bot.API_PER_PAGE]).encode()
+        parser = bot.CatalogParser()
+        result = parser.parse_api(body)
+        same = result == bot.CatalogParser().parse(render_catalog_page(items))[:len(result)]
+        ms = _timeit(lambda: parser.parse_api(body), args.repeat)
+        print(f"{'sintetica-api':<24}{len(body) / 1024:>8.0f}{ms:>13.2f} ms  {len(result)}"
+              f"{'' if same else '  ⚠️ risultati diversi dalla pagina'}  (API, {bot.API_PER_PAGE} per pagina)")
+
+
+def bench_price(args):
+    # Equivalenza con la vecchia implementazione: tests/test_parsing.py
+    parser = bot.CatalogParser()
+    samples = [
+        ('breve', '120,00 €'),
+        ('card', PRICE_GOLDEN[20]),
+        ('testo lungo', PRICE_GOLDEN[-1]),
+        ('senza prezzo', 'Nuovo con cartellino ' * 20),
+    ]
+    print(f"{'testo':<16}{'vecchio':>14}{'nuovo':>14}")
+    for name, text in samples:
+        n = args.repeat * 100
+        old = _timeit(lambda: [legacy_extract_price(text) for _ in range(n)], 5) * 1000 / n
+        new = _timeit(lambda: [parser.extract_price(text) for _ in range(n)], 5) * 1000 / n
+        print(f"{name:<16}{old:>11.2f} µs{new:>11.2f} µs")
+
+
+def bench_cards(args):
+    # Stessi articoli da lxml e html.parser sul corpus di card: tests/test_parsing.py
+    html_parser, lxml_parser = bot.CatalogParser('html.parser'), bot.CatalogParser('lxml')
+    print(f"{'pagina solo HTML':<20}{'KB':>8}{'html.parser':>16}{'lxml':>16}")
+    for count in (40, 96, 400):
+        page = make_catalog_page(count, embedded_json=False)
+        old = _timeit(lambda: html_parser._parse_bs4(page, 'catalog'), args.repeat)
+        new = _timeit(lambda: lxml_parser._parse_lxml(page, 'catalog'), args.repeat)
+        print(f"{f'{count} articoli':<20}{len(page) / 1024:>8.0f}{old:>13.2f} ms{new:>13.2f} ms")
+
+
+# --- Simulazione di carico: Vinted e Telegram finti in un processo separato ---
+
+# Id articolo della ricerca s, posizione k: ITEM_BASE + s * 10**6 + k + ITEM_OFFSET
+ITEM_BASE = 5000000000
+ITEM_OFFSET = 1000
+BENCH_TOKEN = '123456:benchmark'
+
+
+def _search_phase(search):
+    return (search * 0.6180339887) % 1
+
+
+def _item_id(search, k):
+    return ITEM_BASE + search * 10 ** 6 + k + ITEM_OFFSET
+
+
+def _published_at(item_id, t0, period):
+    """Istante (time.time) in cui l'articolo è comparso nel catalogo finto"""
+    search, k = divmod(item_id - ITEM_BASE, 10 ** 6)
+    return t0 + (k - ITEM_OFFSET + 1 - _search_phase(search)) * period
+
+
+def standin_items(search, visible, count):
+    """Articoli della pagina catalogo finta: i `count` più recenti dei primi `visible` pubblicati"""
+    newest = range(visible - 1, visible - 1 - count, -1)
+    return [make_items(1, _item_id(search, k), seed=k)[0] for k in newest]
+
+
+def _serve_standins(conn, opts):
+    """Processo figlio: catalogo Vinted finto + Bot API Telegram finta.
+    
+    Ogni ricerca pubblica un articolo nuovo ogni 60/churn secondi (con una
+    fase diversa per ricerca); la Bot API registra quando arriva ogni articolo.
+    """
+    import threading
+    import hashlib
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    from urllib.parse import urlsplit, parse_qs, unquote_plus
+
+    t0 = time.time()
+    period = 60 / opts['churn'] if opts['churn'] > 0 else float('inf')
+    lock = threading.Lock()
+    pages = {}
+    stats = {'catalog': 0, 'catalog_bytes': 0, 'not_modified': 0, 'throttled': 0, 'telegram': 0, 'flood': 0, 'photo_urls': 0, 'photo_ids': 0}
+    received = []
+    rnd = random.Random(0)
+
+    def render(search, visible, api=False):
+        key = (search, visible, api)
+        with lock:
+            page = pages.get(key)
+        if page is None:
+            items = standin_items(search, visible, opts['page_items'])
+            embedded = opts['variant'] == 'json' or (opts['variant'] == 'mixed' and search % 2 == 0)
+            if api:
+                body = render_catalog_api(items[:bot.API_PER_PAGE]).encode()
+            else:
+                body = render_catalog_page(items, embedded).encode()
+            page = (body, '"%s"' % hashlib.md5(body).hexdigest())
+            with lock:
+                if len(pages) > 4096:
+                    pages.clear()
+                pages[key] = page
+        return page
+
+    class Catalog(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            delay = opts['latency'] + rnd.uniform(0, opts['jitter'])
+            time.sleep(delay / 1000)
+            parts = urlsplit(self.path)
+            query = parse_qs(parts.query)
+            search = int(query.get('search_text', ['bench0'])[0][5:])
+            visible = math.floor((time.time() - t0) / period + _search_phase(search))
+            # Stub dell'endpoint JSON usato con FETCH_MODE=api
+            api = parts.path == '/api/v2/catalog/items'
+            body, etag = render(search, visible, api)
+            with lock:
+                stats['catalog'] += 1
+            if rnd.random() < opts['throttle']:
+                with lock:
+                    stats['throttled'] += 1
+                self.send_response(429)
+                self.send_header('Retry-After', '2')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if opts['etag'] and self.headers.get('If-None-Match') == etag:
+                with lock:
+                    stats['not_modified'] += 1
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json' if api else 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            if opts['etag']:
+                self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(body)
+            with lock:
+                stats['catalog_bytes'] += len(body)
+
+        def log_message(self, *args):
+            pass
+
+    class TelegramApi(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _reply(self, payload, status=200):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            raw = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            method = self.path.rsplit('/', 1)[-1]
+            time.sleep(opts['tg_latency'] / 1000)
+            if method == 'getMe':
+                return self._reply({'ok': True, 'result': {
+                    'id': 123456, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}})
+            if method.startswith('send') and rnd.random() < opts['tg_flood']:
+                with lock:
+                    stats['flood'] += 1
+                return self._reply({'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                                    'parameters': {'retry_after': 1}}, status=429)
+            text = unquote_plus(raw.decode('utf-8', 'replace'))
+            ids = [int(i) for i in bot.ITEM_HREF_RE.findall(text)]
+            with lock:
+                stats['telegram'] += 1
+                received.append((time.time(), ids))
+            chat_id = int(re.search(r'chat_id=(-?\d+)', raw.decode()).group(1)) if b'chat_id=' in raw else 0
+            message = {'message_id': stats['telegram'], 'date': int(time.time()),
+                       'chat': {'id': chat_id, 'type': 'private'}}
+            # Come Telegram: ogni foto inviata torna con un file_id riusabile
+            form = parse_qs(raw.decode('utf-8', 'replace'))
+            if method == 'sendMediaGroup':
+                photos = [m['media'] for m in json.loads(form['media'][0])]
+            else:
+                photos = form.get('photo', [])
+            with lock:
+                for photo in photos:
+                    stats['photo_ids' if photo.startswith('fileid-') else 'photo_urls'] += 1
+
+            def with_photo(photo):
+                file_id = photo if photo.startswith('fileid-') else 'fileid-' + hashlib.md5(photo.encode()).hexdigest()
+                size = {'file_id': file_id, 'file_unique_id': file_id[7:23], 'width': 800, 'height': 600}
+                return dict(message, photo=[size])
+
+            if method == 'sendMediaGroup':
+                return self._reply({'ok': True, 'result': [with_photo(p) for p in photos]})
+            if photos:
+                return self._reply({'ok': True, 'result': with_photo(photos[0])})
+            return self._reply({'ok': True, 'result': message})
+
+        def log_message(self, *args):
+            pass
+
+    servers = [ThreadingHTTPServer(('127.0.0.1', 0), handler) for handler in (Catalog, TelegramApi)]
+    for server in servers:
+        server.daemon_threads = True
+        # Client che chiudono a fine prova (BrokenPipe): non è un errore del benchmark
+        server.handle_error = lambda request, client_address: None
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    conn.send({'catalog_port': servers[0].server_address[1], 'telegram_port': servers[1].server_address[1],
+               't0': t0, 'period': period})
+    conn.recv()  # 'stop'
+    for server in servers:
+        server.shutdown()
+    with lock:
+        conn.send({'stats': dict(stats), 'received': list(received)})
+
+
+def _percentile(values, q):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def _rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        return float('nan')
+
+
+def _hist_delta(name, before, **labels):
+    hist = bot.metrics.histogram(name, **labels) or {'count': 0, 'sum': 0.0}
+    old = before.get((name, tuple(sorted(labels.items()))), (0, 0.0))
+    count, total = hist['count'] - old[0], hist['sum'] - old[1]
+    return count, (total / count * 1000 if count else float('nan'))
+
+
+async def _run_load(args, info):
+    import resource
+    from telegram import Bot
+    from telegram.request import HTTPXRequest
+
+    monitor = bot.monitor
+    # Anche per i processi figli, che rileggono la configurazione dall'ambiente
+    os.environ['FETCH_MODE'] = bot.FETCH_MODE = args.fetch_mode
+    if args.shards:
+        monitor.shards = bot.ShardPool(args.shards)
+        monitor.shards.start()
+    elif args.parse_workers:
+        monitor.fetcher.start_parse_pool(args.parse_workers)
+    total_links = args.users * args.links
+    searches = args.searches or total_links
+    for u in range(args.users):
+        for j in range(args.links):
+            search = (u * args.links + j) % searches
+            url = f"http://127.0.0.1:{info['catalog_port']}/catalog?search_text=bench{search}&order=newest_first"
+            monitor.add_user_link(10 ** 6 + u, url, f"Ricerca {search}", args.interval)
+
+    # Primo giro senza notifiche: al primo check tutti gli articoli sono "nuovi"
+    warm = [monitor.check_new_items(uid, lid)
+            for uid, udata in monitor.data['users'].items() for lid in udata['links']]
+    await asyncio.gather(*warm, return_exceptions=True)
+
+    tg_bot = Bot(BENCH_TOKEN, base_url=f"http://127.0.0.1:{info['telegram_port']}/bot",
+                 request=HTTPXRequest(connection_pool_size=256))
+    await tg_bot.initialize()
+    bot.dispatcher.limiter = bot.RateLimiter(args.tg_rate, args.chat_interval)
+    bot.dispatcher.start(tg_bot)
+    bot.register_gauges()
+
+    before = {key: (h['count'], h['sum']) for key, h in bot.metrics.histograms.items()}
+    sent_before = bot.dispatcher.sent
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    start_wall, start_cpu = time.time(), usage.ru_utime + usage.ru_stime
+
+    tasks = [asyncio.create_task(bot.run_scheduler()), asyncio.create_task(monitor.run_flusher())]
+    await asyncio.sleep(args.duration)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    rss = _rss_mb()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    end_wall, cpu = time.time(), usage.ru_utime + usage.ru_stime - start_cpu
+    # Le notifiche già in coda contano per la latenza, non per il throughput
+    await bot.dispatcher.stop(timeout=10)
+    if monitor.shards:
+        await monitor.shards.stop()
+    monitor.fetcher.stop_parse_pool()
+    await monitor.close()
+    await tg_bot.shutdown()
+    return {
+        'start': start_wall, 'end': end_wall, 'cpu': cpu,
+        'maxrss_mb': usage.ru_maxrss / 1024, 'rss_mb': rss,
+        'checks': _hist_delta('vinted_check_seconds', before),
+        'fetch': _hist_delta('vinted_fetch_seconds', before),
+        'parse_json': _hist_delta('vinted_parse_seconds', before, path='json'),
+        'parse_html': _hist_delta('vinted_parse_seconds', before, path='html'),
+        'parse_api': _hist_delta('vinted_parse_seconds', before, path='api'),
+        'diff': _hist_delta('vinted_diff_seconds', before),
+        'save': _hist_delta('vinted_save_seconds', before),
+        'notify': _hist_delta('vinted_notify_seconds', before),
+        'lag': _hist_delta('vinted_scheduler_lag_seconds', before),
+        'sent': bot.dispatcher.sent - sent_before, 'failed': bot.dispatcher.failed,
+        'links': total_links, 'searches': searches,
+    }
+
+
+def bench_load(args):
+    import multiprocessing
+
+    opts = {k: getattr(args, k) for k in
+            ('churn', 'variant', 'latency', 'jitter', 'page_items', 'etag', 'throttle', 'tg_latency', 'tg_flood')}
+    ctx = multiprocessing.get_context('spawn')
+    conn, child_conn = ctx.Pipe()
+    child = ctx.Process(target=_serve_standins, args=(child_conn, opts), daemon=True)
+    child.start()
+    info = conn.recv()
+    try:
+        result = asyncio.run(_run_load(args, info))
+    finally:
+        conn.send('stop')
+    standins = conn.recv()
+    child.join(5)
+
+    # Latenza di rilevamento: dalla comparsa nel catalogo all'arrivo su Telegram.
+    # Un articolo può arrivare in più chat: conta la prima consegna per chat
+    latencies, detected = [], set()
+    for received_at, ids in standins['received']:
+        for item_id in ids:
+            published = _published_at(item_id, info['t0'], info['period'])
+            if published >= result['start']:
+                latencies.append(received_at - published)
+                detected.add(item_id)
+    # Articoli che avevano tutto il tempo di essere visti: comparsi almeno un
+    # intervallo prima della fine, più la finestra in cui un check riusa la pagina in cache
+    horizon = result['end'] - args.interval - bot.FETCH_CACHE_TTL
+    expected = set()
+    if info['period'] != float('inf'):
+        for search in range(result['searches']):
+            k = math.ceil((result['start'] - info['t0']) / info['period'] + _search_phase(search)) - 1
+            while _published_at(_item_id(search, k), info['t0'], info['period']) < horizon:
+                if _published_at(_item_id(search, k), info['t0'], info['period']) >= result['start']:
+                    expected.add(_item_id(search, k))
+                k += 1
+
+    wall = result['end'] - result['start']
+    checks, check_ms = result['checks']
+    print(f"carico: {args.users} utenti × {args.links} link ({result['links']} link, {result['searches']} ricerche), "
+          f"intervallo {args.interval}s, churn {args.churn}/min, variante {args.variant}, latenza {args.latency} ms, "
+          f"fetch {args.fetch_mode}")
+    print(f"{'durata':<22}{wall:>10.1f} s")
+    print(f"{'check/s':<22}{checks / wall:>10.2f}   ({checks} check, {check_ms:.1f} ms medi)")
+    print(f"{'richieste catalogo':<22}{standins['stats']['catalog']:>10}   "
+          f"(304: {standins['stats']['not_modified']}, 429: {standins['stats']['throttled']})")
+    full = standins['stats']['catalog'] - standins['stats']['not_modified'] - standins['stats']['throttled']
+    print(f"{'KB per risposta':<22}{standins['stats']['catalog_bytes'] / 1024 / max(full, 1):>10.1f}")
+    for label, key in (('fetch', 'fetch'), ('parse JSON', 'parse_json'), ('parse HTML', 'parse_html'),
+                       ('parse API', 'parse_api'),
+                       ('diff', 'diff'), ('salvataggio', 'save'), ('notifica', 'notify')):
+        count, ms = result[key]
+        print(f"{label:<22}{ms:>10.2f} ms ({count})")
+    lag_count, lag_ms = result['lag']
+    print(f"{'ritardo scheduler':<22}{lag_ms / 1000:>10.2f} s medio")
+    print(f"{'messaggi Telegram':<22}{standins['stats']['telegram']:>10}   "
+          f"({result['sent']} articoli inviati, {result['failed']} falliti, {standins['stats']['flood']} 429)")
+    print(f"{'foto':<22}{standins['stats']['photo_urls']:>10}   URL da scaricare, "
+          f"{standins['stats']['photo_ids']} con file_id")
+    print(f"{'rilevamento':<22}p50 {_percentile(latencies, 0.5):.1f} s  p95 {_percentile(latencies, 0.95):.1f} s  "
+          f"max {max(latencies, default=float('nan')):.1f} s")
+    missed = len(expected - detected)
+    print(f"{'articoli rilevati':<22}{len(detected & expected):>10} / {len(expected)}"
+          f"{f'   ⚠️ {missed} persi' if missed else ''}")
+    print(f"{'CPU':<22}{result['cpu'] / wall * 100:>9.1f} %  ({result['cpu']:.2f} s)")
+    print(f"{'memoria':<22}{result['rss_mb']:>7.0f} MB   (picco {result['maxrss_mb']:.0f} MB)")
+
+    if args.json:
+        report = {
+            'users': args.users, 'links': args.links, 'searches': result['searches'],
+            'interval': args.interval, 'churn': args.churn, 'variant': args.variant, 'fetch_mode': args.fetch_mode,
+            'duration': wall,
+            'checks_per_sec': checks / wall, 'catalog_requests': standins['stats']['catalog'],
+            'timings_ms': {key: result[key][1] for key in
+                           ('checks', 'fetch', 'parse_json', 'parse_html', 'parse_api', 'diff', 'save', 'notify')},
+            'detection_latency_s': {'p50': _percentile(latencies, 0.5), 'p95': _percentile(latencies, 0.95),
+                                    'max': max(latencies, default=None)},
+            'detected': len(detected & expected), 'expected': len(expected),
+            'cpu_percent': result['cpu'] / wall * 100, 'rss_mb': result['rss_mb'], 'maxrss_mb': result['maxrss_mb'],
+        }
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 1 if missed else 0
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = ap.add_subparsers(dest='cmd', required=True)
+    p = sub.add_parser('parse', help='tempo di parsing per pagina e per backend')
+    p.add_argument('pages', nargs='*', help='pagine catalogo salvate (.html)')
+    p.add_argument('--repeat', type=int, default=20)
+    p.set_defaults(func=bench_parse)
+    p = sub.add_parser('price', help='extract_price: latenza per chiamata, vecchia e nuova implementazione')
+    p.add_argument('--repeat', type=int, default=20)
+    p.set_defaults(func=bench_price)
+    p = sub.add_parser('cards', help='estrazione dalle card HTML: tempi di html.parser e lxml')
+    p.add_argument('--repeat', type=int, default=10)
+    p.set_defaults(func=bench_cards)
+    p = sub.add_parser('load', help='carico simulato: N utenti × M link contro Vinted e Telegram finti')
+    p.add_argument('--users', type=int, default=20)
+    p.add_argument('--links', type=int, default=5, help='link per utente')
+    p.add_argument('--searches', type=int, default=0, help='ricerche distinte (0 = una per link)')
+    p.add_argument('--interval', type=int, default=60, help='secondi tra i check di un link')
+    p.add_argument('--duration', type=float, default=120, help='secondi di misura')
+    p.add_argument('--churn', type=float, default=2, help='nuovi articoli al minuto per ricerca')
+    p.add_argument('--variant', choices=('json', 'html', 'mixed'), default='json',
+                   help='pagine con JSON embedded, solo HTML o metà e metà')
+    p.add_argument('--page-items', type=int, default=48, help='articoli per pagina catalogo')
+    p.add_argument('--latency', type=float, default=80, help='ms di latenza del catalogo')
+    p.add_argument('--jitter', type=float, default=40, help='ms casuali in più sulla latenza')
+    p.add_argument('--etag', action='store_true', help='il catalogo risponde 304 alle richieste condizionali')
+    p.add_argument('--throttle', type=float, default=0,
+                   help='probabilità che il catalogo risponda 429 con Retry-After')
+    p.add_argument('--tg-latency', type=float, default=30, help='ms di latenza della Bot API')
+    p.add_argument('--tg-flood', type=float, default=0, help='probabilità di un 429 per invio')
+    p.add_argument('--tg-rate', type=float, default=bot.NOTIFY_GLOBAL_RATE, help='messaggi/s globali')
+    p.add_argument('--chat-interval', type=float, default=bot.NOTIFY_CHAT_INTERVAL, help='secondi tra messaggi a una chat')
+    p.add_argument('--fetch-mode', choices=('html', 'api', 'auto'), default=bot.FETCH_MODE,
+                   help='pagina catalogo o endpoint JSON (FETCH_MODE)')
+    p.add_argument('--shards', type=int, default=0, help='processi worker per fetch e parsing (SHARD_WORKERS)')
+    p.add_argument('--parse-workers', type=int, default=0, help='processi per il parsing (PARSE_WORKERS)')
+    p.add_argument('--json', help='salva il risultato in un file JSON (per confronti tra versioni)')
+    p.set_defaults(func=bench_load)
+    args = ap.parse_args()
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,102 +1,854 @@
 import os
+import sys
 import json
+import base64
+import time
+import sqlite3
+import threading
+import zlib
+import math
+import heapq
+import bisect
 import asyncio
+import multiprocessing
+import hashlib
 import logging
+from array import array
+from functools import partial
+from collections import OrderedDict
+from contextlib import contextmanager, suppress
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from html import escape as html_escape
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
+from telegram import __version__ as telegram_version
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
-import requests
+import httpx
 from bs4 import BeautifulSoup
 import re
 
+try:
+    from lxml import html as lxml_html
+except ImportError:
+    lxml_html = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 DATA_FILE = 'vinted_data.json'
+DB_FILE = os.getenv('DB_FILE', 'vinted_data.db')
 
-class VintedMonitor:
+# Scrittura differita: i link modificati vengono salvati a blocchi
+FLUSH_INTERVAL = float(os.getenv('FLUSH_INTERVAL', '5'))
+FLUSH_BATCH_SIZE = int(os.getenv('FLUSH_BATCH_SIZE', '100'))
+
+# Quanti id articolo ricordare per link per riconoscere quelli già notificati
+# (250 = 10 pagine da 25: ~5 KB in RAM, array più stringa salvata, e ~2.7 KB su disco per link)
+SEEN_IDS_LIMIT = int(os.getenv('SEEN_IDS_LIMIT', '250'))
+
+# Controllo adattivo: le ricerche con molti nuovi articoli vengono controllate
+# più spesso (fino a ADAPTIVE_MIN_INTERVAL), quelle ferme più di rado
+ADAPTIVE_POLLING = os.getenv('ADAPTIVE_POLLING', '0') == '1'
+ADAPTIVE_MIN_INTERVAL = int(os.getenv('ADAPTIVE_MIN_INTERVAL', '60'))
+# Nuovi articoli attesi per check e finestra (secondi) della media del ritmo di arrivo
+ADAPTIVE_TARGET_NEW = float(os.getenv('ADAPTIVE_TARGET_NEW', '1'))
+ADAPTIVE_WINDOW = float(os.getenv('ADAPTIVE_WINDOW', '3600'))
+
+# Notifiche: worker dedicati e limiti di Telegram (~30 msg/s globali, ~1 msg/s per chat)
+NOTIFY_WORKERS = int(os.getenv('NOTIFY_WORKERS', '4'))
+NOTIFY_GLOBAL_RATE = float(os.getenv('NOTIFY_GLOBAL_RATE', '25'))
+NOTIFY_CHAT_INTERVAL = float(os.getenv('NOTIFY_CHAT_INTERVAL', '1'))
+NOTIFY_MAX_RETRIES = int(os.getenv('NOTIFY_MAX_RETRIES', '5'))
+# Da quanti articoli insieme si passa a album + riepilogo invece di un messaggio per articolo
+NOTIFY_GROUP_THRESHOLD = int(os.getenv('NOTIFY_GROUP_THRESHOLD', '4'))
+
+# Foto già inviate: URL -> file_id di Telegram, riusato per le altre chat
+PHOTO_CACHE_SIZE = int(os.getenv('PHOTO_CACHE_SIZE', '5000'))
+PHOTO_CACHE_TTL = float(os.getenv('PHOTO_CACHE_TTL', str(24 * 3600)))
+
+# Fetch asincrono: quante richieste HTTP possono essere in volo contemporaneamente
+FETCH_CONCURRENCY = int(os.getenv('FETCH_CONCURRENCY', '20'))
+FETCH_TIMEOUT = float(os.getenv('FETCH_TIMEOUT', '20'))
+
+# Limite per host: token bucket con rate adattivo (AIMD). Il rate sale di
+# HOST_RATE_STEP a ogni risposta buona e si dimezza (HOST_BACKOFF) su 429/403/5xx
+HOST_RATE = float(os.getenv('HOST_RATE', '5'))
+HOST_RATE_MIN = float(os.getenv('HOST_RATE_MIN', '0.2'))
+HOST_RATE_MAX = float(os.getenv('HOST_RATE_MAX', '20'))
+HOST_BURST = float(os.getenv('HOST_BURST', '5'))
+HOST_RATE_STEP = float(os.getenv('HOST_RATE_STEP', '0.05'))
+HOST_BACKOFF = float(os.getenv('HOST_BACKOFF', '0.5'))
+# Link con fetch fallito: nuovo tentativo dopo FETCH_RETRY_DELAY, raddoppiato
+# a ogni errore di fila, mai oltre il suo intervallo normale
+FETCH_RETRY_DELAY = float(os.getenv('FETCH_RETRY_DELAY', '30'))
+# Sessioni HTTP a rotazione (cookie separati) e User-Agent alternativi separati da "|"
+FETCH_SESSIONS = int(os.getenv('FETCH_SESSIONS', '1'))
+FETCH_USER_AGENTS = [ua.strip() for ua in os.getenv('FETCH_USER_AGENTS', '').split('|') if ua.strip()]
+
+# Come si scaricano le ricerche: 'html' (pagina catalogo), 'api' (endpoint JSON
+# degli articoli, pagina HTML solo se l'URL non si traduce) o 'auto' (come 'api',
+# ma si ripiega sulla pagina anche quando l'API risponde male)
+FETCH_MODE = os.getenv('FETCH_MODE', 'html')
+# Host dell'API (vuoto = lo stesso dell'URL catalogo), utile per uno stub locale
+VINTED_API_BASE = os.getenv('VINTED_API_BASE', '')
+API_PER_PAGE = int(os.getenv('API_PER_PAGE', '25'))
+# In 'auto', dopo un errore dell'API quell'host usa la pagina per N secondi
+API_FALLBACK_TTL = float(os.getenv('API_FALLBACK_TTL', '600'))
+
+# Controlli periodici: numero di worker, cioè di check contemporanei
+# (le richieste HTTP, anche di /test, sono limitate da FETCH_CONCURRENCY)
+CHECK_WORKERS = int(os.getenv('CHECK_WORKERS', '10'))
+
+# Sharding: N processi worker fanno fetch e parsing, ognuno per una parte
+# delle ricerche (0 = tutto nel processo del bot)
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', '0'))
+SHARD_VNODES = int(os.getenv('SHARD_VNODES', '64'))
+SHARD_RESPAWN_DELAY = float(os.getenv('SHARD_RESPAWN_DELAY', '5'))
+
+# Risultati condivisi: una ricerca identica viene scaricata una sola volta per finestra
+FETCH_CACHE_TTL = float(os.getenv('FETCH_CACHE_TTL', '30'))
+# /test e le anteprime accettano risultati un po' più vecchi del checker
+INTERACTIVE_CACHE_TTL = float(os.getenv('INTERACTIVE_CACHE_TTL', '120'))
+# Ultimo risultato (con ETag/Last-Modified e digest) per al massimo N ricerche
+PAGE_CACHE_SIZE = int(os.getenv('PAGE_CACHE_SIZE', '1024'))
+
+# Metriche: endpoint Prometheus locale (0 = disattivato) e admin per /stats
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+ADMIN_IDS = {int(i) for i in os.getenv('ADMIN_IDS', '').replace(' ', '').split(',') if i}
+
+# Webhook: con WEBHOOK_URL (es. https://vinted-bot.up.railway.app) Telegram
+# invia gli update a WEBHOOK_URL/WEBHOOK_PATH invece del long polling.
+# Lo stesso server risponde su /healthz e /readyz; Railway passa la porta in PORT
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '').rstrip('/')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram').strip('/')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('PORT', '8443'))
+# Header segreto che Telegram rimanda a ogni update (vuoto = derivato dal token)
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+# Gli unici update gestiti dagli handler: gli altri Telegram non li manda nemmeno
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+# Parser HTML: 'auto' (lxml se installato), 'lxml' o 'html.parser'
+PARSER_BACKEND = os.getenv('PARSER_BACKEND', 'auto')
+# Parsing in processi separati, così il loop resta libero per Telegram (0 = nel loop)
+PARSE_WORKERS = int(os.getenv('PARSE_WORKERS', '0'))
+# Pagine in parsing o in attesa oltre le quali i fetch si fermano ad aspettare
+PARSE_QUEUE_SIZE = int(os.getenv('PARSE_QUEUE_SIZE', str(max(PARSE_WORKERS, 1) * 4)))
+# Ordine dei campi nelle tuple che tornano dal pool di parsing
+ITEM_FIELDS = ('id', 'title', 'price', 'currency', 'url', 'photo')
+
+ITEM_HREF_RE = re.compile(r'/items/(\d+)')
+STATE_MARKERS = (b'window.__NUXT__', b'window.__INITIAL_STATE__')
+STATE_SCRIPT_XPATH = "//script[contains(., 'window.__NUXT__') or contains(., 'window.__INITIAL_STATE__')]/text()"
+
+# Prezzi: un'unica regex compilata al posto dei vecchi nove pattern.
+# Numero: migliaia all'europea (1.234,56 / 1 234,56), all'inglese (1,234.56)
+# oppure il formato semplice 250 / 250,00 / 250.00
+_PRICE_NUM = r'\d{1,3}(?:[.\u00a0\u202f]\d{3})+(?:,\d+)?(?!\d|[.,]\d)|\d{1,3}(?:,\d{3})+\.\d+|\d+[,.]?\d*'
+PRICE_RE = re.compile(
+    # Filtro sul primo carattere: nelle altre posizioni non prova nemmeno le alternative
+    r'(?=[\d€epci])(?:'
+    # €250 / EUR 250 / Price: 250 / Prezzo: 250 / Costa: 250
+    rf'(?:€|EUR|price[:\s]+|prezzo[:\s]+|cost[oa][:\s]+)\s*(?P<pre>{_PRICE_NUM})'
+    # 250€ / 250 EUR / 250 euro (lookahead: il simbolo resta per il prezzo dopo)
+    rf'|(?P<suf>{_PRICE_NUM})(?=\s*(?:€|EUR|euro))'
+    # include...250: il primo numero dopo "include"
+    rf'|include\D*(?P<inc>{_PRICE_NUM}))',
+    re.IGNORECASE
+)
+EU_THOUSANDS_RE = re.compile(r'\d{1,3}(?:\.\d{3})+(?:,\d+)?')
+EN_THOUSANDS_RE = re.compile(r'\d{1,3}(?:,\d{3})+\.\d+')
+
+# Parametri che non cambiano i risultati della ricerca
+TRACKING_PARAMS = {'time', 'search_id', 'ref', 'referrer', 'fbclid', 'gclid'}
+
+# Parametri della pagina catalogo -> parametri di /api/v2/catalog/items.
+# I filtri ripetuti (catalog[]=1&catalog[]=2) diventano liste con le virgole
+CATALOG_API_PARAMS = {
+    'search_text': 'search_text',
+    'catalog[]': 'catalog_ids',
+    'brand_ids[]': 'brand_ids',
+    'size_ids[]': 'size_ids',
+    'color_ids[]': 'color_ids',
+    'status_ids[]': 'status_ids',
+    'material_ids[]': 'material_ids',
+    'video_game_platform_ids[]': 'video_game_platform_ids',
+    'price_from': 'price_from',
+    'price_to': 'price_to',
+    'currency': 'currency',
+}
+# Parametri che l'API riceve comunque a modo suo (ordine sempre newest_first)
+CATALOG_API_IGNORED = {'order', 'page', 'per_page', 'disabled_personalization'}
+# /catalog oppure /catalog/1904-donna (categoria nel path)
+CATALOG_PATH_RE = re.compile(r'^/catalog(?:/(\d+)(?:-[^/]*)?)?/?$')
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Language': 'it-IT,it;q=0.9',
+}
+
+def normalize_vinted_url(url):
+    """Forma canonica di un URL catalogo: ricerche equivalenti danno la stessa stringa"""
+    parts = urlsplit(url.strip())
+    params = [
+        (k, v) for k, v in parse_qsl(parts.query)
+        if k.lower() not in TRACKING_PARAMS and not k.lower().startswith('utm_')
+    ]
+    # L'ordine dei parametri (e dei valori ripetuti come catalog[]) non conta
+    params.sort()
+    return urlunsplit((
+        (parts.scheme or 'https').lower(),
+        parts.netloc.lower(),
+        parts.path.rstrip('/') or '/',
+        urlencode(params),
+        '',
+    ))
+
+def catalog_api_url(url, per_page=API_PER_PAGE):
+    """URL dell'endpoint JSON equivalente a una ricerca catalogo.
+    
+    None se l'URL non è un catalogo o ha parametri che l'API non conosce:
+    meglio la pagina HTML che una ricerca con un filtro perso per strada.
+    """
+    parts = urlsplit(url)
+    match = CATALOG_PATH_RE.match(parts.path)
+    if not match:
+        return None
+    params = {}
+    if match.group(1):
+        params['catalog_ids'] = [match.group(1)]
+    for key, value in parse_qsl(parts.query):
+        lower = key.lower()
+        if lower in CATALOG_API_IGNORED or lower in TRACKING_PARAMS or lower.startswith('utm_'):
+            continue
+        name = CATALOG_API_PARAMS.get(key)
+        if name is None:
+            return None
+        params.setdefault(name, []).append(value)
+    query = [(name, ','.join(values)) for name, values in sorted(params.items())]
+    query += [('order', 'newest_first'), ('page', '1'), ('per_page', str(per_page))]
+    base = VINTED_API_BASE.rstrip('/') or f"{parts.scheme}://{parts.netloc}"
+    return f"{base}/api/v2/catalog/items?{urlencode(query)}"
+
+class Metrics:
+    """Contatori, gauge e istogrammi in memoria, esportati in formato Prometheus.
+    
+    Ogni serie è identificata da nome + etichette; i gauge possono essere
+    funzioni, lette solo quando qualcuno chiede le metriche.
+    """
+    
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    
     def __init__(self):
-        self.data = self.load_data()
-        self.session = requests.Session()
-        self._setup_session()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
     
-    def _setup_session(self):
-        self.session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-            'Accept-Language': 'it-IT,it;q=0.9',
-        })
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
     
-    def load_data(self):
-        if os.path.exists(DATA_FILE):
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+    
+    def set(self, name, value, **labels):
+        """value può essere un numero o una funzione senza argomenti"""
+        self.gauges[self._key(name, labels)] = value
+    
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        hist = self.histograms.get(key)
+        if hist is None:
+            # conteggi per bucket (+Inf in fondo), somma, numero, massimo
+            hist = self.histograms[key] = {'buckets': [0] * (len(self.BUCKETS) + 1), 'sum': 0.0, 'count': 0, 'max': 0.0}
+        i = 0
+        while i < len(self.BUCKETS) and value > self.BUCKETS[i]:
+            i += 1
+        hist['buckets'][i] += 1
+        hist['sum'] += value
+        hist['count'] += 1
+        hist['max'] = max(hist['max'], value)
+    
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+    
+    def counter(self, name, **labels):
+        return self.counters.get(self._key(name, labels), 0)
+    
+    def counter_by(self, name, label):
+        """Valori di un contatore raggruppati per una etichetta"""
+        out = {}
+        for (n, labels), value in self.counters.items():
+            if n == name:
+                lv = dict(labels).get(label, '')
+                out[lv] = out.get(lv, 0) + value
+        return out
+    
+    def gauge(self, name, **labels):
+        value = self.gauges.get(self._key(name, labels), 0)
+        return value() if callable(value) else value
+    
+    def histogram(self, name, **labels):
+        return self.histograms.get(self._key(name, labels))
+    
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+    
+    def render(self):
+        """Testo nel formato di esposizione Prometheus"""
+        lines = []
+        typed = set()
+        
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} {kind}')
+        
+        for (name, labels), value in sorted(self.counters.items()):
+            header(name, 'counter')
+            lines.append(f'{name}{self._labels(labels)} {value}')
+        for (name, labels), value in sorted(self.gauges.items(), key=lambda kv: kv[0]):
             try:
-                with open(DATA_FILE, 'r') as f:
-                    return json.load(f)
-            except:
-                return {'users': {}}
-        return {'users': {}}
+                value = value() if callable(value) else value
+            except Exception:
+                continue
+            header(name, 'gauge')
+            lines.append(f'{name}{self._labels(labels)} {value}')
+        for (name, labels), hist in sorted(self.histograms.items(), key=lambda kv: kv[0]):
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + ('+Inf',), hist['buckets']):
+                cumulative += count
+                lines.append(f'{name}_bucket{self._labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_sum{self._labels(labels)} {hist["sum"]:.6f}')
+            lines.append(f'{name}_count{self._labels(labels)} {hist["count"]}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+async def serve_metrics(host=METRICS_HOST, port=METRICS_PORT, ready=None):
+    """Endpoint HTTP minimale: GET /metrics restituisce metrics.render(),
+    /healthz risponde sempre e /readyz 200 o 503 secondo ready()"""
+    async def handle(reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            # Il resto della richiesta (header) non serve
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request.split()
+            path = parts[1].split(b'?')[0] if len(parts) >= 2 else b''
+            if path == b'/metrics':
+                status, body = '200 OK', metrics.render().encode()
+            elif path == b'/healthz':
+                status, body = '200 OK', b'ok\n'
+            elif path == b'/readyz' and ready is not None:
+                status, body = ('200 OK', b'ready\n') if ready() else ('503 Service Unavailable', b'not ready\n')
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            writer.write(
+                f'HTTP/1.1 {status}\r\n'
+                f'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                f'Connection: close\r\n\r\n'.encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            # Client lento o sparito: normale, non è un errore dell'exporter
+            logger.debug(f"Richiesta metriche interrotta: {e!r}")
+        except Exception as e:
+            logger.warning(f"⚠️ Errore endpoint metriche: {e!r}")
+        finally:
+            writer.close()
     
-    def save_data(self):
-        with open(DATA_FILE, 'w') as f:
-            json.dump(self.data, f, indent=2)
+    server = await asyncio.start_server(handle, host, port)
+    logger.info(f"📈 Metriche su http://{host}:{port}/metrics")
+    return server
+
+class FetchError(Exception):
+    """Fetch fallito (rete, 429, 5xx...): diverso da una ricerca senza articoli"""
     
-    def add_user_link(self, user_id, link, name, interval=180):
-        user_id = str(user_id)
-        if user_id not in self.data['users']:
-            self.data['users'][user_id] = {'links': {}}
-        link_id = str(len(self.data['users'][user_id]['links']) + 1)
-        self.data['users'][user_id]['links'][link_id] = {
-            'url': link, 
-            'name': name, 
-            'last_items': [], 
-            'added_at': datetime.now().isoformat(),
-            'check_interval': interval
-        }
-        self.save_data()
-        return link_id
+    def __init__(self, message, retry_after=None, status=None):
+        super().__init__(message, retry_after, status)
+        self.retry_after = retry_after
+        self.status = status
     
-    def remove_user_link(self, user_id, link_id):
-        user_id = str(user_id)
-        if user_id in self.data['users'] and link_id in self.data['users'][user_id]['links']:
-            del self.data['users'][user_id]['links'][link_id]
-            self.save_data()
-            return True
-        return False
+    def __str__(self):
+        return self.args[0]
+
+def parse_retry_after(value):
+    """Header Retry-After (secondi o data HTTP) -> secondi, None se assente"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+        return max((when - datetime.now(when.tzinfo)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
+
+class HostRateLimiter:
+    """Token bucket per host con rate adattivo (AIMD) e rispetto di Retry-After"""
     
-    def get_user_links(self, user_id):
-        user_id = str(user_id)
-        return self.data['users'].get(user_id, {}).get('links', {})
+    def __init__(self, rate=HOST_RATE, burst=HOST_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._hosts = {}
     
-    def extract_price(self, text):
-        """Estrae il prezzo in tutti i formati possibili"""
-        # Pulisci il testo
-        text = text.replace('\n', ' ').replace('\r', ' ')
-        
-        # Pattern multipli per catturare OGNI formato di prezzo
-        patterns = [
-            r'€\s*(\d+[,.]?\d*)',                    # €250.00 o €250,00
-            r'(\d+[,.]?\d*)\s*€',                    # 250.00€ o 250,00€  
-            r'(\d+[,.]?\d*)\s*EUR',                  # 250.00 EUR
-            r'EUR\s*(\d+[,.]?\d*)',                  # EUR 250.00
-            r'[Pp]rice[:\s]+(\d+[,.]?\d*)',          # Price: 250.00
-            r'[Pp]rezzo[:\s]+(\d+[,.]?\d*)',         # Prezzo: 250.00
-            r'[Cc]ost[oa][:\s]+(\d+[,.]?\d*)',       # Costa: 250.00
-            r'(\d+[,.]?\d*)\s*euro',                 # 250 euro
-            r'include.*?(\d+[,.]?\d*)',              # include...250
-        ]
+    def _state(self, host):
+        state = self._hosts.get(host)
+        if state is None:
+            state = self._hosts[host] = {
+                'rate': self.rate, 'tokens': self.burst, 'updated': time.monotonic(), 'blocked_until': 0.0,
+            }
+            metrics.set('vinted_host_rate', lambda: state['rate'], host=host)
+        return state
+    
+    async def acquire(self, host):
+        state = self._state(host)
+        while True:
+            now = time.monotonic()
+            if state['blocked_until'] > now:
+                await asyncio.sleep(state['blocked_until'] - now)
+                continue
+            state['tokens'] = min(self.burst, state['tokens'] + (now - state['updated']) * state['rate'])
+            state['updated'] = now
+            if state['tokens'] >= 1:
+                state['tokens'] -= 1
+                return
+            await asyncio.sleep((1 - state['tokens']) / state['rate'])
+    
+    def on_success(self, host):
+        state = self._state(host)
+        state['rate'] = min(HOST_RATE_MAX, state['rate'] + HOST_RATE_STEP)
+    
+    def on_throttle(self, host, retry_after=None):
+        """429/403/5xx: rate dimezzato, e nessuna richiesta fino a Retry-After"""
+        state = self._state(host)
+        state['rate'] = max(HOST_RATE_MIN, state['rate'] * HOST_BACKOFF)
+        state['tokens'] = min(state['tokens'], 0)
+        if retry_after:
+            state['blocked_until'] = max(state['blocked_until'], time.monotonic() + retry_after)
+        logger.warning(f"🐢 {host}: rallento a {state['rate']:.2f} richieste/s"
+                       + (f", pausa {retry_after:.0f}s" if retry_after else ""))
+
+class VintedStore:
+    """Archivio SQLite: una riga per link, ogni salvataggio è una transazione"""
+    
+    def __init__(self, path=DB_FILE):
+        # La connessione è usata anche dal thread del flusher
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS links ('
+                ' user_id TEXT NOT NULL,'
+                ' link_id TEXT NOT NULL,'
+                ' data TEXT NOT NULL,'
+                ' PRIMARY KEY (user_id, link_id))'
+            )
+            # La chiave primaria fa già da indice su user_id
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_links_link_id ON links (link_id)')
+    
+    def is_empty(self):
+        return self.conn.execute('SELECT 1 FROM links LIMIT 1').fetchone() is None
+    
+    def load(self):
+        data = {'users': {}}
+        for user_id, link_id, blob in self.conn.execute('SELECT user_id, link_id, data FROM links'):
+            data['users'].setdefault(user_id, {'links': {}})['links'][link_id] = json.loads(blob)
+        return data
+    
+    def save_links(self, rows):
+        """Salva (user_id, link_id, link_data) in un'unica transazione"""
+        self.apply([(user_id, link_id, json.dumps(link_data)) for user_id, link_id, link_data in rows], [])
+    
+    def apply(self, upserts, deletes):
+        """Scrive righe già serializzate e cancellazioni in un'unica transazione"""
+        with self.lock, self.conn:
+            if upserts:
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO links (user_id, link_id, data) VALUES (?, ?, ?)', upserts
+                )
+            if deletes:
+                self.conn.executemany('DELETE FROM links WHERE user_id = ? AND link_id = ?', deletes)
+    
+    def close(self):
+        self.conn.close()
+
+class SeenIds:
+    """Ultimi id articolo visti da un link.
+    
+    Un solo array di interi a 64 bit in ordine di inserimento: oltre il
+    limite escono i più vecchi. Nessun set tenuto in memoria: il confronto
+    di un check usa un set temporaneo (pochi centinaia di id contro ~25 articoli).
+    Su disco diventa una stringa base64: 8 byte per id invece del dict intero.
+    """
+    
+    def __init__(self, encoded=None, limit=SEEN_IDS_LIMIT):
+        self.limit = limit
+        self.ids = array('Q')
+        if encoded:
+            self.ids.frombytes(base64.b64decode(encoded))
+            if sys.byteorder != 'little':
+                self.ids.byteswap()
+            # Salvato con un limite più alto: restano i più recenti
+            del self.ids[:max(len(self.ids) - limit, 0)]
+    
+    @staticmethod
+    def _key(item_id):
+        item_id = str(item_id)
+        return int(item_id) if item_id.isdigit() else zlib.crc32(item_id.encode())
+    
+    def __contains__(self, item_id):
+        # Scansione lineare: per i confronti in blocco c'è new_items
+        return self._key(item_id) in self.ids
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    def new_items(self, items):
+        """Gli articoli (dict con 'id') non ancora visti, nell'ordine dato"""
+        index = set(self.ids)
+        return [item for item in items if self._key(item['id']) not in index]
+    
+    def add_many(self, item_ids):
+        index = set(self.ids)
+        for item_id in item_ids:
+            key = self._key(item_id)
+            if key not in index:
+                index.add(key)
+                self.ids.append(key)
+        overflow = len(self.ids) - self.limit
+        if overflow > 0:
+            del self.ids[:overflow]
+    
+    def encode(self):
+        ids = self.ids
+        if sys.byteorder != 'little':
+            ids = array('Q', ids)
+            ids.byteswap()
+        return base64.b64encode(ids.tobytes()).decode('ascii')
+
+class LinkScheduler:
+    """Min-heap delle prossime scadenze dei link, chiave (user_id, link_id).
+    
+    Rimozioni e ripianificazioni sono lazy: nel heap restano voci vecchie che
+    vengono scartate quando arrivano in cima, confrontandole con self._due.
+    """
+    
+    def __init__(self):
+        self._heap = []
+        self._due = {}
+        self._wakeup = asyncio.Event()
+    
+    def __len__(self):
+        return len(self._due)
+    
+    def schedule(self, user_id, link_id, delay):
+        key = (str(user_id), str(link_id))
+        due = time.monotonic() + max(delay, 0)
+        self._due[key] = due
+        heapq.heappush(self._heap, (due, key))
+        if self._heap[0][1] == key:
+            # Nuova scadenza più vicina: sveglia il loop
+            self._wakeup.set()
+        if len(self._heap) > 2 * len(self._due) + 64:
+            self._compact()
+    
+    def is_scheduled(self, user_id, link_id):
+        """False anche mentre il link è in check (estratto e non ancora ripianificato)"""
+        return (str(user_id), str(link_id)) in self._due
+    
+    def unschedule(self, user_id, link_id):
+        self._due.pop((str(user_id), str(link_id)), None)
+    
+    def _compact(self):
+        self._heap = [(due, key) for key, due in self._due.items()]
+        heapq.heapify(self._heap)
+    
+    def _drop_stale(self):
+        while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+    
+    def next_delay(self):
+        """Secondi alla prossima scadenza (None se non c'è niente da fare)"""
+        self._drop_stale()
+        if not self._heap:
+            return None
+        return max(self._heap[0][0] - time.monotonic(), 0)
+    
+    def pop_due(self):
+        """Estrae tutti i link scaduti come lista di (chiave, scadenza)"""
+        now = time.monotonic()
+        ready = []
+        while True:
+            self._drop_stale()
+            if not self._heap or self._heap[0][0] > now:
+                return ready
+            due, key = heapq.heappop(self._heap)
+            del self._due[key]
+            ready.append((key, due))
+    
+    async def wait(self):
+        """Dorme fino alla prossima scadenza o finché non ne arriva una più vicina"""
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=self.next_delay())
+        except asyncio.TimeoutError:
+            pass
+
+def _price_to_float(num):
+    """'250,00' / '1.234,56' / '1 234,56' / '1,234.56' -> float"""
+    num = num.replace('\u00a0', '').replace('\u202f', '')
+    if EU_THOUSANDS_RE.fullmatch(num):
+        num = num.replace('.', '').replace(',', '.')
+    elif EN_THOUSANDS_RE.fullmatch(num):
+        num = num.replace(',', '')
+    else:
+        num = num.replace(',', '.')
+    try:
+        return float(num)
+    except ValueError:
+        return None
+
+def _loads(payload):
+    """json.loads, con orjson se installato"""
+    if orjson is not None:
+        return orjson.loads(payload)
+    return json.loads(payload)
+
+def _state_payloads(body):
+    """Byte dei JSON assegnati a window.__NUXT__ / __INITIAL_STATE__ ("marker = {")"""
+    for marker in STATE_MARKERS:
+        pos = body.find(marker)
+        while pos != -1:
+            after = pos + len(marker)
+            eq = body.find(b'=', after)
+            start = body.find(b'{', eq + 1) if eq != -1 else -1
+            end = body.find(b'</script', start) if start != -1 else -1
+            # Solo assegnazioni dirette, con eventuali spazi
+            if end != -1 and not body[after:eq].strip() and not body[eq + 1:start].strip():
+                yield body[start:end].rstrip().rstrip(b';')
+            pos = body.find(marker, after)
+
+def find_state_json(body):
+    """Cerca lo stato embedded (window.__NUXT__ = {...}) direttamente nei byte
+    della risposta e decodifica solo quel JSON, senza costruire il DOM.
+    
+    Restituisce None se non lo trova: in quel caso serve il parsing completo.
+    """
+    for payload in _state_payloads(body):
+        try:
+            return _loads(payload)
+        except ValueError:
+            # Dopo l'oggetto c'è altro codice: decodifica solo il primo valore
+            try:
+                text = payload.decode('utf-8', 'replace')
+                return json.JSONDecoder().raw_decode(text)[0]
+            except ValueError:
+                pass
+    return None
+
+def page_digest(body):
+    """Impronta della parte di pagina che contiene gli articoli.
+    
+    Lo stato JSON se c'è, altrimenti il tratto tra il primo e l'ultimo link
+    /items/: così token e timestamp nel resto della pagina non contano.
+    """
+    section = next(_state_payloads(body), None)
+    if section is None:
+        first, last = body.find(b'/items/'), body.rfind(b'/items/')
+        section = body[first:last + 64] if first != -1 else body
+    return hashlib.blake2b(section, digest_size=16).hexdigest()
+
+def _follow_path(data, path):
+    """Segue un percorso di chiavi/indici nello stato JSON (None se non esiste)"""
+    for key in path:
+        if isinstance(data, dict):
+            data = data.get(key)
+        elif isinstance(data, list) and isinstance(key, int) and key < len(data):
+            data = data[key]
+        else:
+            return None
+    return data
+
+def page_type_for_url(url):
+    """Tipo di pagina per l'indice dei percorsi: primo segmento del path"""
+    return urlsplit(url).path.strip('/').split('/')[0] or 'home'
+
+TITLE_CANDIDATE_TAGS = {'div', 'p', 'span', 'h2', 'h3', 'h4'}
+HEADING_TAGS = {'h1', 'h2', 'h3', 'h4'}
+
+def _walk_card(container):
+    """Visita una sola volta il sottoalbero di una card articolo.
+    
+    Raccoglie i pezzi di testo nello stesso ordine di itertext() e, per gli
+    elementi che servono (primo titolo h1-h4, prima descrizione, primo
+    data-testid prezzo, candidati per il titolo), solo l'intervallo di pezzi
+    che contengono: il loro testo si ricava poi senza altre visite.
+    """
+    pieces = []
+    card = {'heading': None, 'desc': None, 'price': None, 'img': None, 'candidates': []}
+    
+    def walk(el, is_root):
+        tag = el.tag
+        slots = []
+        if not is_root:
+            if card['heading'] is None and tag in HEADING_TAGS:
+                slots.append('heading')
+            if card['desc'] is None and tag in ('p', 'div') and 'desc' in (el.get('class') or '').lower():
+                slots.append('desc')
+            if card['price'] is None and 'price' in (el.get('data-testid') or '').lower():
+                slots.append('price')
+            if card['img'] is None and tag == 'img':
+                card['img'] = el
+            if tag in TITLE_CANDIDATE_TAGS:
+                span = [len(pieces), None]
+                card['candidates'].append(span)
+            # Segna lo slot subito: il primo in ordine di documento vince
+            for slot in slots:
+                card[slot] = [len(pieces), None]
+        
+        if el.text:
+            pieces.append(el.text)
+        for child in el:
+            # Commenti e istruzioni: niente testo, ma la coda sì (come itertext)
+            if isinstance(child.tag, str):
+                walk(child, False)
+            if child.tail:
+                pieces.append(child.tail)
         
+        if not is_root:
+            end = len(pieces)
+            for slot in slots:
+                card[slot][1] = end
+            if tag in TITLE_CANDIDATE_TAGS:
+                span[1] = end
+    
+    walk(container, True)
+    
+    def text(span, strip=False):
+        chunk = pieces[span[0]:span[1]]
+        return ''.join(p.strip() for p in chunk) if strip else ''.join(chunk)
+    
+    card['pieces'] = pieces
+    card['text'] = text
+    return card
+
+def _stripped_text(elem):
+    """Equivalente lxml di get_text(strip=True) di BeautifulSoup"""
+    return ''.join(s.strip() for s in elem.itertext())
+
+class CatalogParser:
+    """Estrae gli articoli da una pagina catalogo.
+    
+    Il backend 'lxml' usa XPath ed è molto più veloce; se lxml manca, fallisce
+    o non trova niente si ricade sul parsing originale con html.parser.
+    """
+    
+    def __init__(self, backend=PARSER_BACKEND):
+        if backend == 'auto':
+            backend = 'lxml' if lxml_html is not None else 'html.parser'
+        if backend == 'lxml' and lxml_html is None:
+            logger.warning("⚠️ lxml non disponibile, uso html.parser")
+            backend = 'html.parser'
+        self.backend = backend
+        # Indice dei percorsi: tipo di pagina -> chiavi per arrivare a 'items'
+        self.item_paths = {}
+        self.path_hits = 0
+        self.path_misses = 0
+        # Come sono stati estratti gli articoli nell'ultima parse (json, lxml, html.parser, api, none)
+        self.last_method = None
+        # Etichetta path di vinted_parse_seconds dell'ultima parse (json, html, api)
+        self.last_path = None
+    
+    def parse(self, body, page_type='catalog'):
+        """body: byte della risposta (o stringa)"""
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        
+        # Metodo 1 veloce: JSON dello stato trovato nei byte, nessun DOM
+        with metrics.timer('vinted_parse_seconds', path='json'):
+            data = find_state_json(body)
+            items = self._extract_items_from_json(data, page_type) if data is not None else None
+        if items:
+            logger.info(f"✅ Trovati {len(items)} articoli da JSON!")
+            self.last_method = 'json'
+            self.last_path = 'json'
+            metrics.inc('vinted_extraction_total', method='json')
+            return items
+        
+        # Parsing completo solo se il percorso veloce fallisce
+        with metrics.timer('vinted_parse_seconds', path='html'):
+            items, method = self._parse_html(body.decode('utf-8', 'replace'), page_type)
+        self.last_method = method if items else 'none'
+        self.last_path = 'html'
+        metrics.inc('vinted_extraction_total', method=self.last_method)
+        return items
+    
+    def parse_api(self, body):
+        """Risposta di /api/v2/catalog/items: solo JSON, niente pagina da attraversare.
+        
+        None se la risposta non ha la forma attesa (lista 'items'),
+        [] per una ricerca valida senza risultati.
+        """
+        with metrics.timer('vinted_parse_seconds', path='api'):
+            try:
+                data = _loads(body)
+            except ValueError:
+                data = None
+            raw_items = data.get('items') if isinstance(data, dict) else None
+            items = (self._items_from_list(raw_items) or []) if isinstance(raw_items, list) else None
+        self.last_method = 'api' if items is not None else 'none'
+        self.last_path = 'api'
+        metrics.inc('vinted_extraction_total', method=self.last_method)
+        return items
+    
+    def _parse_html(self, html, page_type):
+        """Restituisce (articoli, backend usato)"""
+        if self.backend == 'lxml':
+            try:
+                items = self._parse_lxml(html, page_type)
+                if items:
+                    return items, 'lxml'
+            except Exception as e:
+                logger.warning(f"⚠️ Parsing lxml fallito, uso html.parser: {e}")
+        return self._parse_bs4(html, page_type), 'html.parser'
+    
+    def extract_price(self, text):
+        """Estrae il prezzo in tutti i formati possibili (una sola passata sul testo)"""
         all_prices = []
         
-        for pattern in patterns:
-            matches = re.finditer(pattern, text, re.IGNORECASE)
-            for match in matches:
-                price_str = match.group(1).replace(',', '.')
-                try:
-                    price_val = float(price_str)
-                    if 0.01 <= price_val <= 99999:
-                        all_prices.append(price_val)
-                except:
-                    continue
+        for match in PRICE_RE.finditer(text):
+            price_val = _price_to_float(match.group('pre') or match.group('suf') or match.group('inc'))
+            if price_val is not None and 0.01 <= price_val <= 99999:
+                all_prices.append(price_val)
         
         if all_prices:
             # Prendi il prezzo più alto (di solito è quello con Protezione)
@@ -105,16 +857,101 @@ class VintedMonitor:
         
         return None
     
-    def fetch_vinted_items(self, url):
+    def _items_from_state_script(self, text, page_type):
+        """JSON dello stato (window.__NUXT__ / __INITIAL_STATE__) -> articoli"""
         try:
-            logger.info(f"🔍 Fetching: {url[:100]}")
-            response = self.session.get(url, timeout=20)
-            logger.info(f"📊 Status: {response.status_code}")
-            
-            if response.status_code != 200:
-                return []
-            
-            soup = BeautifulSoup(response.text, 'html.parser')
+            # Estrai il JSON
+            json_match = re.search(r'=\s*({.+})', text, re.DOTALL)
+            if json_match:
+                data = json.loads(json_match.group(1).rstrip(';'))
+                return self._extract_items_from_json(data, page_type)
+        except Exception:
+            pass
+        return None
+    
+    def _parse_lxml(self, html, page_type):
+        """Backend veloce: albero lxml e query XPath mirate"""
+        doc = lxml_html.fromstring(html)
+        
+        # Metodo 1: JSON embedded, solo gli script che lo contengono
+        for text in doc.xpath(STATE_SCRIPT_XPATH):
+            items = self._items_from_state_script(text, page_type)
+            if items:
+                logger.info(f"✅ Trovati {len(items)} articoli da JSON!")
+                return items
+        
+        # Metodo 2: Parsing HTML
+        logger.info("🔍 Parsing HTML (lxml)...")
+        all_links = [a for a in doc.xpath("//a[contains(@href, '/items/')]") if ITEM_HREF_RE.search(a.get('href'))]
+        logger.info(f"🔗 Link articoli: {len(all_links)}")
+        
+        items = []
+        seen_ids = set()
+        
+        for link in all_links[:40]:
+            try:
+                href = link.get('href', '')
+                item_id = ITEM_HREF_RE.search(href).group(1)
+                if item_id in seen_ids:
+                    continue
+                seen_ids.add(item_id)
+                url = href if href.startswith('http') else f"https://www.vinted.it{href}"
+                
+                # Cerca nel parent del link
+                container = next(link.iterancestors('div', 'article', 'li'), link)
+                
+                # Una sola visita della card per testo, titolo, descrizione, prezzo e foto
+                card = _walk_card(container)
+                full_text = ' '.join(card['pieces'])
+                if card['heading']:
+                    full_text += ' ' + card['text'](card['heading'])
+                if card['desc']:
+                    full_text += ' ' + card['text'](card['desc'])
+                
+                # Titolo
+                title = link.get('title') or _stripped_text(link) or "Articolo"
+                if len(title) < 5 or title.isdigit():
+                    for span in card['candidates']:
+                        txt = card['text'](span, strip=True)
+                        if 10 < len(txt) < 150 and not txt.replace(' ', '').isdigit():
+                            if not re.search(r'^\d+[,.]?\d*\s*€', txt):
+                                title = txt
+                                break
+                
+                # Prezzo
+                price = self.extract_price(full_text)
+                if not price and card['price']:
+                    price = self.extract_price(card['text'](card['price']))
+                
+                # Foto
+                photo = None
+                img = card['img']
+                if img is not None:
+                    photo = img.get('src') or img.get('data-src') or img.get('data-lazy-src')
+                    if photo and ('placeholder' in photo or 'data:image' in photo):
+                        photo = img.get('data-src') or img.get('data-lazy-src')
+                
+                if (title != "Articolo" and len(title) > 5) or price:
+                    items.append({
+                        'id': item_id,
+                        'title': title[:120],
+                        'price': price or "N/D",
+                        'currency': '€',
+                        'url': url,
+                        'photo': photo
+                    })
+                    logger.info(f"  ✓ {title[:40]} - {price or 'N/D'}€")
+            except Exception as e:
+                logger.error(f"  ✗ Errore parsing item: {e}")
+                continue
+        
+        logger.info(f"✅ Totale: {len(items)} articoli estratti")
+        return items[:25]
+    
+    def _parse_bs4(self, html, page_type):
+        """Backend originale: BeautifulSoup con html.parser"""
+        try:
+            soup = BeautifulSoup(html, 'html.parser')
             
             # Metodo 1: Cerca JSON embedded
             scripts = soup.find_all('script')
@@ -124,21 +961,14 @@ class VintedMonitor:
                 
                 # Cerca window.__NUXT__ o simili
                 if 'window.__NUXT__' in script.string or 'window.__INITIAL_STATE__' in script.string:
-                    try:
-                        # Estrai il JSON
-                        json_match = re.search(r'=\s*({.+})', script.string, re.DOTALL)
-                        if json_match:
-                            data = json.loads(json_match.group(1).rstrip(';'))
-                            items = self._extract_items_from_json(data)
-                            if items:
-                                logger.info(f"✅ Trovati {len(items)} articoli da JSON!")
-                                return items
-                    except:
-                        continue
+                    items = self._items_from_state_script(script.string, page_type)
+                    if items:
+                        logger.info(f"✅ Trovati {len(items)} articoli da JSON!")
+                        return items
             
             # Metodo 2: Parsing HTML
             logger.info("🔍 Parsing HTML...")
-            all_links = soup.find_all('a', href=re.compile(r'/items/\d+'))
+            all_links = soup.find_all('a', href=ITEM_HREF_RE)
             logger.info(f"🔗 Link articoli: {len(all_links)}")
             
             items = []
@@ -147,7 +977,7 @@ class VintedMonitor:
             for link in all_links[:40]:
                 try:
                     href = link.get('href', '')
-                    id_match = re.search(r'/items/(\d+)', href)
+                    id_match = ITEM_HREF_RE.search(href)
                     if not id_match or id_match.group(1) in seen_ids:
                         continue
                     
@@ -220,54 +1050,1012 @@ class VintedMonitor:
             return items[:25]
             
         except Exception as e:
-            logger.error(f"❌ Errore fetch: {e}")
+            logger.error(f"❌ Errore parsing: {e}")
             return []
     
-    def _extract_items_from_json(self, data, depth=0, max_depth=10):
-        """Estrae items da JSON ricorsivamente"""
-        if depth > max_depth:
-            return None
+    def _items_from_list(self, raw_items):
+        """Converte la lista 'items' dello stato nel formato del bot"""
+        items = []
+        for item in raw_items[:25]:
+            if not isinstance(item, dict) or 'id' not in item:
+                continue
+            
+            price = item.get('total_item_price', item.get('price', '0'))
+            currency = item.get('currency', '€')
+            if isinstance(price, dict):
+                # Formato dell'API: {"amount": "12.0", "currency_code": "EUR"}
+                currency = price.get('currency_code', currency)
+                price = price.get('amount', '0')
+            price = str(price)
+            
+            photo = None
+            if 'photo' in item and isinstance(item['photo'], dict):
+                photo = item['photo'].get('url')
+            
+            items.append({
+                'id': str(item['id']),
+                'title': item.get('title', 'Articolo')[:120],
+                'price': price,
+                'currency': currency,
+                'url': item.get('url', f"https://www.vinted.it/items/{item['id']}"),
+                'photo': photo
+            })
+        
+        return items if items else None
+    
+    def _extract_items_from_json(self, data, page_type='catalog'):
+        """Estrae items dallo stato JSON.
+        
+        Prova prima il percorso dove li ha trovati l'ultima volta per questo
+        tipo di pagina; solo se non funziona più rifà la visita completa e
+        impara il nuovo percorso.
+        """
+        path = self.item_paths.get(page_type)
+        if path is not None:
+            node = _follow_path(data, path)
+            if isinstance(node, dict) and isinstance(node.get('items'), list):
+                items = self._items_from_list(node['items'])
+                if items:
+                    self.path_hits += 1
+                    return items
+        
+        self.path_misses += 1
+        found = self._find_items_path(data, ())
+        if not found:
+            return None
+        path, items = found
+        if self.item_paths.get(page_type) != path:
+            logger.info(f"🧭 Articoli in {'/'.join(map(str, path)) or '/'} ({page_type})")
+            self.item_paths[page_type] = path
+        return items
+    
+    def _find_items_path(self, data, path, depth=0, max_depth=10):
+        """Visita ricorsiva: restituisce (percorso, items) del primo 'items' valido"""
+        if depth > max_depth:
+            return None
+        
+        if isinstance(data, dict):
+            if 'items' in data and isinstance(data['items'], list):
+                items = self._items_from_list(data['items'])
+                return (path, items) if items else None
+            
+            for key, value in data.items():
+                result = self._find_items_path(value, path + (key,), depth + 1, max_depth)
+                if result:
+                    return result
+        
+        elif isinstance(data, list):
+            for i, item in enumerate(data):
+                result = self._find_items_path(item, path + (i,), depth + 1, max_depth)
+                if result:
+                    return result
+        
+        return None
+    
+    def path_index_stats(self):
+        return {'hits': self.path_hits, 'misses': self.path_misses, 'paths': len(self.item_paths)}
+
+# Parser del processo del pool, creato una volta dall'initializer
+_pool_parser = None
+
+def _init_parse_worker():
+    global _pool_parser
+    _pool_parser = CatalogParser()
+
+def parse_in_worker(body, page_type):
+    """Gira nel pool: restituisce tuple compatte (ITEM_FIELDS) invece di dict.
+    
+    Con gli articoli tornano anche hit/miss dell'indice dei percorsi e il
+    percorso imparato, così i contatori del processo del bot restano veri.
+    """
+    start = time.perf_counter()
+    hits, misses = _pool_parser.path_hits, _pool_parser.path_misses
+    items = _pool_parser.parse(body, page_type)
+    rows = [tuple(item[f] for f in ITEM_FIELDS) for item in items]
+    index = (_pool_parser.path_hits - hits, _pool_parser.path_misses - misses,
+             _pool_parser.item_paths.get(page_type))
+    return rows, _pool_parser.last_method, _pool_parser.last_path, index, time.perf_counter() - start
+
+class PageFetcher:
+    """Fetch e parsing delle pagine catalogo con cache condivisa.
+    
+    Vive nel processo del bot e, con lo sharding, in ogni processo worker.
+    """
+    
+    def __init__(self, parser=None):
+        self.parser = parser or CatalogParser()
+        # Client async (uno per sessione, usati a rotazione; creati al primo uso)
+        self.clients = [None] * max(FETCH_SESSIONS, len(FETCH_USER_AGENTS), 1)
+        self._next_client = 0
+        self.host_limiter = HostRateLimiter()
+        self.fetch_semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+        # LRU: url normalizzato -> ultimo risultato (items, digest, validatori)
+        self._fetch_cache = OrderedDict()
+        self._inflight = {}
+        self.cache_stats = {'fresh': 0, 'not_modified': 0, 'unchanged': 0, 'parsed': 0}
+        # host -> fino a quando (monotonic) non si prova l'API ('auto')
+        self._api_down_until = {}
+        # Pool di parsing (None = parsing nel loop) e posti in coda
+        self.parse_pool = None
+        self.parse_slots = asyncio.Semaphore(PARSE_QUEUE_SIZE)
+        self.parse_inflight = 0
+    
+    def start_parse_pool(self, workers=PARSE_WORKERS):
+        self.parse_pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_parse_worker,
+        )
+        logger.info(f"🧠 Parsing su {workers} processi (coda max {PARSE_QUEUE_SIZE})")
+    
+    def stop_parse_pool(self):
+        if self.parse_pool is not None:
+            self.parse_pool.shutdown(wait=False, cancel_futures=True)
+            self.parse_pool = None
+    
+    async def _parse(self, body, url):
+        """Parsing nel pool se attivo; i byte passano al processo così come sono.
+        
+        Quando la coda è piena il fetch aspetta qui: il check resta occupato
+        e il rallentamento risale fino allo scheduler invece di accumulare pagine.
+        """
+        if self.parse_pool is None:
+            return self.parse_vinted_page(body, url)
+        
+        queued_at = time.perf_counter()
+        async with self.parse_slots:
+            metrics.observe('vinted_parse_wait_seconds', time.perf_counter() - queued_at)
+            self.parse_inflight += 1
+            pool = self.parse_pool
+            try:
+                loop = asyncio.get_running_loop()
+                page_type = page_type_for_url(url)
+                rows, method, path, index, seconds = await loop.run_in_executor(
+                    pool, parse_in_worker, body, page_type
+                )
+            except BrokenProcessPool:
+                # Un processo del pool è morto: si ricrea il pool (una volta sola
+                # anche se falliscono più pagine insieme) e questa pagina si fa qui
+                if self.parse_pool is pool:
+                    logger.error("❌ Pool di parsing interrotto, lo riavvio")
+                    metrics.inc('vinted_parse_pool_restarts_total')
+                    self.stop_parse_pool()
+                    self.start_parse_pool(pool._max_workers)
+                return self.parse_vinted_page(body, url)
+            finally:
+                self.parse_inflight -= 1
+        
+        hits, misses, item_path = index
+        self.parser.path_hits += hits
+        self.parser.path_misses += misses
+        if item_path is not None:
+            self.parser.item_paths[page_type] = item_path
+        metrics.observe('vinted_parse_seconds', seconds, path=path)
+        metrics.inc('vinted_extraction_total', method=method)
+        return [dict(zip(ITEM_FIELDS, row)) for row in rows]
+    
+    def _get_client(self, index=None):
+        """Prossimo client della rotazione (o quello indicato): (indice, client HTTP con keep-alive)"""
+        if index is None:
+            index = self._next_client
+            self._next_client = (index + 1) % len(self.clients)
+        client = self.clients[index]
+        if client is None or client.is_closed:
+            headers = dict(HEADERS)
+            if FETCH_USER_AGENTS:
+                headers['User-Agent'] = FETCH_USER_AGENTS[index % len(FETCH_USER_AGENTS)]
+            client = self.clients[index] = httpx.AsyncClient(
+                headers=headers,
+                timeout=FETCH_TIMEOUT,
+                follow_redirects=True,
+                limits=httpx.Limits(
+                    max_connections=FETCH_CONCURRENCY,
+                    max_keepalive_connections=FETCH_CONCURRENCY,
+                ),
+            )
+        return index, client
+    
+    def _reset_client(self, index):
+        """Sessione bloccata (403/429): la prossima richiesta ne apre una con cookie nuovi"""
+        client = self.clients[index]
+        self.clients[index] = None
+        if client is not None:
+            # Chiusa più tardi: altre richieste potrebbero ancora usarla
+            asyncio.get_running_loop().call_later(
+                FETCH_TIMEOUT, lambda: asyncio.ensure_future(client.aclose())
+            )
+    
+    async def close(self):
+        for index, client in enumerate(self.clients):
+            if client is not None:
+                await client.aclose()
+            self.clients[index] = None
+    
+    async def fetch_page(self, url, max_age=None):
+        """Restituisce (items, digest) della ricerca.
+        
+        Le ricerche equivalenti condividono un solo fetch: se è già in corso
+        si aspetta quello, se è appena finito si riusa il risultato.
+        max_age (secondi) sostituisce FETCH_CACHE_TTL per decidere cosa è "appena".
+        Solleva FetchError se la pagina non si può scaricare.
+        """
+        key = normalize_vinted_url(url)
+        if max_age is None:
+            max_age = FETCH_CACHE_TTL
+        cached = self._fetch_cache.get(key)
+        if cached and time.monotonic() - cached['fetched_at'] < max_age:
+            self._fetch_cache.move_to_end(key)
+            self.cache_stats['fresh'] += 1
+            return cached['items'], cached['digest']
+        
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch_and_parse(key))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shield: se un chiamante viene cancellato il fetch condiviso continua
+        return await asyncio.shield(task)
+    
+    def _store_fetch_result(self, key, response, items, digest, source):
+        # Un 304 può non ripetere i validatori: in quel caso restano quelli di prima
+        previous = self._fetch_cache.get(key) or {}
+        if previous.get('source') != source:
+            previous = {}
+        self._fetch_cache[key] = {
+            'items': items,
+            'digest': digest,
+            'source': source,
+            'etag': response.headers.get('ETag') or previous.get('etag'),
+            'last_modified': response.headers.get('Last-Modified') or previous.get('last_modified'),
+            'fetched_at': time.monotonic(),
+        }
+        self._fetch_cache.move_to_end(key)
+        while len(self._fetch_cache) > PAGE_CACHE_SIZE:
+            self._fetch_cache.popitem(last=False)
+    
+    def _conditional_headers(self, cached, source):
+        """If-None-Match/If-Modified-Since, solo se il risultato in cache viene dalla stessa fonte"""
+        headers = {}
+        if cached and cached['source'] == source:
+            # Richiesta condizionale: se la pagina non è cambiata arriva un 304 vuoto
+            if cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
+        return headers
+    
+    async def _request(self, url, headers, index=None):
+        """GET rispettando il limite dell'host: (indice del client, risposta).
+        
+        Solleva FetchError per errori di rete e per 403/429/5xx, che rallentano l'host.
+        """
+        host = urlsplit(url).netloc
+        await self.host_limiter.acquire(host)
+        try:
+            async with self.fetch_semaphore:
+                logger.info(f"🔍 Fetching: {url[:100]}")
+                index, client = self._get_client(index)
+                with metrics.timer('vinted_fetch_seconds'):
+                    response = await client.get(url, headers=headers)
+        except Exception as e:
+            logger.error(f"❌ Errore fetch: {e}")
+            metrics.inc('vinted_fetch_errors_total', error=type(e).__name__)
+            raise FetchError(f"{type(e).__name__}: {e}") from e
+        logger.info(f"📊 Status: {response.status_code}")
+        metrics.inc('vinted_fetch_status_total', code=response.status_code)
+        
+        status = response.status_code
+        if status in (403, 429) or status >= 500:
+            # Troppe richieste (o blocco anti-bot): si rallenta tutto l'host
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            self.host_limiter.on_throttle(host, retry_after)
+            metrics.inc('vinted_host_throttled_total', host=host, code=status)
+            if status in (403, 429):
+                self._reset_client(index)
+            raise FetchError(f"HTTP {status}", retry_after, status)
+        self.host_limiter.on_success(host)
+        return index, response
+    
+    async def _fetch_and_parse(self, url):
+        api_url = catalog_api_url(url) if FETCH_MODE in ('api', 'auto') else None
+        host = urlsplit(url).netloc
+        if api_url is not None and self._api_down_until.get(host, 0) <= time.monotonic():
+            try:
+                return await self._fetch_api(url, api_url)
+            except FetchError as e:
+                # In 'auto' si ripiega sulla pagina, ma non se Vinted sta
+                # rallentando l'host: sarebbero solo altre richieste
+                if FETCH_MODE != 'auto' or e.status is None or e.status in (403, 429) or e.status >= 500:
+                    raise
+                logger.warning(f"⚠️ API catalogo non disponibile ({e}), uso la pagina per {API_FALLBACK_TTL:.0f}s")
+                metrics.inc('vinted_api_fallback_total')
+                self._api_down_until[host] = time.monotonic() + API_FALLBACK_TTL
+        return await self._fetch_html(url)
+    
+    async def _fetch_html(self, url):
+        cached = self._fetch_cache.get(url)
+        _, response = await self._request(url, self._conditional_headers(cached, 'html'))
+        status = response.status_code
+        if status == 304 and cached:
+            self.cache_stats['not_modified'] += 1
+            self._store_fetch_result(url, response, cached['items'], cached['digest'], 'html')
+            return cached['items'], cached['digest']
+        
+        if status != 200:
+            raise FetchError(f"HTTP {status}", status=status)
+        
+        digest = page_digest(response.content)
+        if cached and cached['digest'] == digest:
+            # Stessi articoli dell'ultima volta: niente parsing
+            self.cache_stats['unchanged'] += 1
+            items = cached['items']
+        else:
+            self.cache_stats['parsed'] += 1
+            items = await self._parse(response.content, url)
+        self._store_fetch_result(url, response, items, digest, 'html')
+        return items, digest
+    
+    async def _fetch_api(self, url, api_url):
+        """Stessa ricerca dall'endpoint JSON: risposta piccola, parsing senza HTML"""
+        cached = self._fetch_cache.get(url)
+        headers = self._conditional_headers(cached, 'api')
+        headers['Accept'] = 'application/json'
+        index, response = await self._request(api_url, headers)
+        if response.status_code == 401:
+            # L'API vuole i cookie che il sito assegna alla prima visita:
+            # si apre la home con lo stesso client e si riprova una volta
+            parts = urlsplit(api_url)
+            await self._request(f"{parts.scheme}://{parts.netloc}/", {}, index)
+            index, response = await self._request(api_url, headers, index)
+        status = response.status_code
+        if status == 304 and cached:
+            self.cache_stats['not_modified'] += 1
+            self._store_fetch_result(url, response, cached['items'], cached['digest'], 'api')
+            return cached['items'], cached['digest']
+        
+        if status != 200:
+            raise FetchError(f"API HTTP {status}", status=status)
+        
+        digest = page_digest(response.content)
+        if cached and cached['source'] == 'api' and cached['digest'] == digest:
+            self.cache_stats['unchanged'] += 1
+            items = cached['items']
+        else:
+            self.cache_stats['parsed'] += 1
+            items = self.parser.parse_api(response.content)
+            if items is None:
+                raise FetchError("API: risposta non valida", status=status)
+        self._store_fetch_result(url, response, items, digest, 'api')
+        return items, digest
+    
+    def page_cache_summary(self):
+        """Contatori della cache pagine con hit rate (fresh + 304 + digest uguale)"""
+        stats = dict(self.cache_stats)
+        total = sum(stats.values())
+        hits = total - stats['parsed']
+        stats['hit_rate'] = round(hits / total, 3) if total else 0.0
+        stats['entries'] = len(self._fetch_cache)
+        return stats
+    
+    def parse_vinted_page(self, body, url=''):
+        """Estrae gli articoli da una pagina catalogo (byte o stringa)"""
+        return self.parser.parse(body, page_type_for_url(url) if url else 'catalog')
+
+def _ring_hash(key):
+    # hash() di Python cambia tra processi: serve un hash stabile
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+class HashRing:
+    """Consistent hashing: aggiungere o togliere un nodo sposta solo le sue chiavi"""
+    
+    def __init__(self, vnodes=SHARD_VNODES):
+        self.vnodes = vnodes
+        self._owners = {}
+        self._points = []
+    
+    def __len__(self):
+        return len(set(self._owners.values()))
+    
+    def add(self, node):
+        for i in range(self.vnodes):
+            self._owners[_ring_hash(f"{node}#{i}")] = node
+        self._points = sorted(self._owners)
+    
+    def remove(self, node):
+        self._owners = {h: n for h, n in self._owners.items() if n != node}
+        self._points = sorted(self._owners)
+    
+    def node_for(self, key):
+        if not self._points:
+            return None
+        i = bisect.bisect(self._points, _ring_hash(key)) % len(self._points)
+        return self._owners[self._points[i]]
+
+def run_shard_worker(conn):
+    """Processo worker: riceve (id, url, max_age), risponde (id, items, digest)
+    oppure (id, None, FetchError) se il fetch è fallito"""
+    asyncio.run(_shard_worker_loop(conn))
+
+async def _shard_worker_loop(conn):
+    loop = asyncio.get_running_loop()
+    fetcher = PageFetcher()
+    stopped = loop.create_future()
+    tasks = set()
+    
+    async def handle(req_id, url, max_age):
+        try:
+            items, digest = await fetcher.fetch_page(url, max_age)
+        except FetchError as e:
+            # items None: nel processo del bot diventa di nuovo FetchError
+            items, digest = None, e
+        except Exception as e:
+            logger.error(f"❌ Errore worker: {e}")
+            items, digest = None, FetchError(f"worker: {e}")
+        conn.send((req_id, items, digest))
+    
+    def submit(request):
+        if request is None:
+            if not stopped.done():
+                stopped.set_result(None)
+            return
+        task = loop.create_task(handle(*request))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    
+    def reader():
+        # recv blocca: sta in un thread, le richieste passano al loop
+        try:
+            while True:
+                request = conn.recv()
+                loop.call_soon_threadsafe(submit, request)
+                if request is None:
+                    return
+        except (EOFError, OSError):
+            loop.call_soon_threadsafe(submit, None)
+    
+    threading.Thread(target=reader, daemon=True).start()
+    await stopped
+    for task in tasks:
+        task.cancel()
+    await fetcher.close()
+
+class ShardPool:
+    """Processi worker per fetch e parsing, ognuno con una parte delle ricerche.
+    
+    Le ricerche sono assegnate con consistent hashing sull'URL normalizzato:
+    la stessa ricerca va sempre allo stesso worker, così cache, ETag e fetch
+    condivisi restano efficaci. Se un worker muore le sue ricerche passano
+    agli altri e, quando viene riavviato con lo stesso nome, tornano a lui.
+    """
+    
+    def __init__(self, size=SHARD_WORKERS):
+        self.size = size
+        self.ring = HashRing()
+        self.workers = {}
+        self._pending = {}
+        self._next_id = 0
+        self._ctx = multiprocessing.get_context('spawn')
+        self._loop = None
+        self._closing = False
+    
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        for i in range(self.size):
+            self._spawn(f"shard-{i}")
+        logger.info(f"🧩 Sharding attivo su {self.size} processi")
+    
+    def _spawn(self, name):
+        conn, child_conn = self._ctx.Pipe()
+        process = self._ctx.Process(target=run_shard_worker, args=(child_conn,), name=name, daemon=True)
+        process.start()
+        child_conn.close()
+        self.workers[name] = (process, conn)
+        self.ring.add(name)
+        threading.Thread(target=self._reader, args=(name, conn), daemon=True).start()
+    
+    def _reader(self, name, conn):
+        """Thread che riceve le risposte di un worker"""
+        try:
+            while True:
+                reply = conn.recv()
+                self._loop.call_soon_threadsafe(self._resolve, *reply)
+        except (EOFError, OSError):
+            try:
+                self._loop.call_soon_threadsafe(self._worker_lost, name)
+            except RuntimeError:
+                pass  # Loop già chiuso
+    
+    def _resolve(self, req_id, items, digest):
+        entry = self._pending.pop(req_id, None)
+        if entry and not entry[0].done():
+            if items is None:
+                entry[0].set_exception(digest)
+            else:
+                entry[0].set_result((items, digest))
+    
+    def _worker_lost(self, name):
+        if self._closing or name not in self.workers:
+            return
+        process, conn = self.workers.pop(name)
+        self.ring.remove(name)
+        conn.close()
+        process.join(0.5)  # La pipe si chiude quando il processo sta uscendo
+        logger.warning(f"⚠️ Worker {name} terminato (exit {process.exitcode}): le sue ricerche passano agli altri")
+        metrics.inc('vinted_shard_worker_exits_total')
+        for req_id, (future, owner) in list(self._pending.items()):
+            if owner == name and not future.done():
+                future.set_exception(ConnectionError(f"worker {name} terminato"))
+        self._loop.call_later(SHARD_RESPAWN_DELAY, self._respawn, name)
+    
+    def _respawn(self, name):
+        if self._closing or name in self.workers:
+            return
+        logger.info(f"♻️ Riavvio il worker {name}")
+        self._spawn(name)
+    
+    async def fetch_page(self, url, max_age=None):
+        key = normalize_vinted_url(url)
+        # Se il worker muore durante la richiesta si riprova sul nuovo proprietario
+        for attempt in range(2):
+            name = self.ring.node_for(key)
+            if name is None:
+                break
+            self._next_id += 1
+            req_id = self._next_id
+            future = self._loop.create_future()
+            self._pending[req_id] = (future, name)
+            try:
+                self.workers[name][1].send((req_id, key, max_age))
+                metrics.inc('vinted_shard_requests_total', shard=name)
+                return await asyncio.wait_for(future, FETCH_TIMEOUT * 3)
+            except (ConnectionError, OSError):
+                self._pending.pop(req_id, None)
+                self._worker_lost(name)
+            except asyncio.TimeoutError:
+                logger.error(f"❌ Timeout dal worker {name} per {key[:100]}")
+                raise FetchError(f"timeout dal worker {name}")
+            finally:
+                self._pending.pop(req_id, None)
+        raise FetchError("nessun worker disponibile")
+    
+    async def stop(self, timeout=5):
+        self._closing = True
+        for process, conn in self.workers.values():
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+        for process, conn in self.workers.values():
+            await asyncio.to_thread(process.join, timeout)
+            if process.is_alive():
+                process.terminate()
+            conn.close()
+        self.workers.clear()
+        for future, _ in self._pending.values():
+            future.cancel()
+
+class ItemFilter:
+    """Regole di filtro di un link, compilate una volta.
+    
+    rules: min / max (prezzo), include / exclude (parole nel titolo),
+    regex (sul titolo), foto (quanti articoli senza foto al massimo per check)
+    """
+    
+    def __init__(self, rules):
+        self.rules = rules
+        self.min_price = rules.get('min')
+        self.max_price = rules.get('max')
+        self.include = frozenset(k.lower() for k in rules.get('include', ()))
+        self.exclude = frozenset(k.lower() for k in rules.get('exclude', ()))
+        # re.error qui: la regex sbagliata viene rifiutata quando si imposta il filtro
+        self.regex = re.compile(rules['regex'], re.IGNORECASE) if rules.get('regex') else None
+        self.max_no_photo = rules.get('foto')
+    
+    @property
+    def keywords(self):
+        return self.include | self.exclude
+    
+    def apply(self, items, features):
+        """Articoli che passano il filtro; features è condiviso da tutti i link della ricerca"""
+        kept = []
+        no_photo = 0
+        for item in items:
+            price, words, has_photo = features.get(item)
+            if self.min_price is not None and (price is None or price < self.min_price):
+                continue
+            if self.max_price is not None and (price is None or price > self.max_price):
+                continue
+            if self.include and not (words & self.include):
+                continue
+            if words & self.exclude:
+                continue
+            if self.regex is not None and not features.matches(self.regex, item):
+                continue
+            if not has_photo and self.max_no_photo is not None:
+                if no_photo >= self.max_no_photo:
+                    continue
+                no_photo += 1
+            kept.append(item)
+        return kept
+
+class FilterFeatures:
+    """Dati degli articoli di un risultato usati dai filtri, calcolati una volta.
+    
+    Le parole chiave di tutti i link sulla stessa ricerca stanno in un'unica
+    regex: ogni titolo viene scansionato una volta sola, qualunque sia il
+    numero di iscritti. La regex è un lookahead, quindi trova le parole anche
+    quando si sovrappongono ("nike air" e "air max" in "nike air max").
+    Le regex dei filtri sono valutate una volta per pattern.
+    """
+    
+    def __init__(self, keyword_re, keywords):
+        self.keyword_re = keyword_re
+        self.keywords = keywords
+        self._items = {}
+        self._regex = {}
+    
+    def get(self, item):
+        entry = self._items.get(item['id'])
+        if entry is None:
+            words = set()
+            if self.keyword_re is not None:
+                for match in self.keyword_re.finditer(item['title'].lower()):
+                    # Una sola parola per posizione, la più lunga: le altre che
+                    # iniziano lì ("nike" in "nike air") ne sono sottostringhe
+                    text = match.group(1)
+                    words.update(k for k in self.keywords if k in text)
+            entry = (
+                _price_to_float(str(item['price'])),
+                frozenset(words),
+                bool(item['photo'] and 'http' in item['photo']),
+            )
+            self._items[item['id']] = entry
+        return entry
+    
+    def matches(self, regex, item):
+        results = self._regex.setdefault(regex.pattern, {})
+        hit = results.get(item['id'])
+        if hit is None:
+            hit = results[item['id']] = regex.search(item['title']) is not None
+        return hit
+
+class VintedMonitor:
+    def __init__(self):
+        self.store = VintedStore()
+        self.parser = CatalogParser()
+        self.data = self.load_data()
+        # Link modificati ma non ancora scritti su disco
+        self._dirty = set()
+        self._flush_event = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        # Scrittura in corso nel thread (può sopravvivere al flush che l'ha avviata)
+        self._write = None
+        self.scheduler = LinkScheduler()
+        self._schedule_all()
+        self.fetcher = PageFetcher(self.parser)
+        # Pool di processi che fanno fetch e parsing (None = tutto in questo processo)
+        self.shards = None
+        # Filtri compilati per link, regex delle parole chiave per ricerca e
+        # dati degli articoli per risultato (url normalizzato, digest)
+        self._filters = {}
+        self._keyword_res = {}
+        self._features = OrderedDict()
+        # (user_id, link_id) -> fetch falliti di fila
+        self._fetch_failures = {}
+        # (user_id, link_id) -> SeenIds già decodificato
+        self._seen = {}
+    
+    def load_data(self):
+        if self.store.is_empty() and os.path.exists(DATA_FILE):
+            self._import_json()
+        return self.store.load()
+    
+    def _import_json(self):
+        """Migrazione una tantum dal vecchio vinted_data.json"""
+        try:
+            with open(DATA_FILE, 'r') as f:
+                old = json.load(f)
+        except Exception as e:
+            logger.error(f"❌ {DATA_FILE} illeggibile, non migrato: {e}")
+            return
+        self.store.save_links(
+            (uid, lid, ldata)
+            for uid, udata in old.get('users', {}).items()
+            for lid, ldata in udata.get('links', {}).items()
+        )
+        os.replace(DATA_FILE, DATA_FILE + '.migrated')
+        logger.info(f"📦 Dati migrati da {DATA_FILE} a {DB_FILE}")
+    
+    def mark_dirty(self, user_id, link_id, urgent=False):
+        """Segna un link da salvare; il flusher lo scriverà nel prossimo blocco"""
+        self._dirty.add((str(user_id), link_id))
+        if urgent or len(self._dirty) >= FLUSH_BATCH_SIZE:
+            self._flush_event.set()
+    
+    async def flush(self):
+        """Scrive su disco tutti i link modificati (i rimossi vengono cancellati)"""
+        async with self._flush_lock:
+            if self._write is not None and not self._write.done():
+                # Un flush cancellato ha lasciato il thread a metà: si aspetta
+                # che finisca prima di riscrivere (o di chiudere il database)
+                await asyncio.gather(self._write, return_exceptions=True)
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, set()
+            upserts, deletes = [], []
+            for user_id, link_id in dirty:
+                link_data = self.get_user_links(user_id).get(link_id)
+                if link_data is None:
+                    deletes.append((user_id, link_id))
+                else:
+                    # Serializza qui: nel thread i dict potrebbero cambiare sotto i piedi
+                    upserts.append((user_id, link_id, json.dumps(link_data)))
+            self._write = asyncio.ensure_future(asyncio.to_thread(self.store.apply, upserts, deletes))
+            try:
+                with metrics.timer('vinted_save_seconds'):
+                    await asyncio.shield(self._write)
+            except asyncio.CancelledError:
+                # Finché la scrittura non è confermata il blocco resta da salvare
+                self._dirty |= dirty
+                raise
+            except Exception as e:
+                logger.error(f"❌ Errore salvataggio: {e}")
+                metrics.inc('vinted_save_errors_total')
+                self._dirty |= dirty
+                return
+            metrics.inc('vinted_saved_links_total', len(upserts) + len(deletes))
+            logger.info(f"💾 Salvati {len(upserts)} link, rimossi {len(deletes)}")
+    
+    async def run_flusher(self):
+        """Salva ogni FLUSH_INTERVAL secondi o prima se il blocco è pieno"""
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), timeout=FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            await self.flush()
+    
+    def _initial_delay(self, user_id, link_id, link_data, spread):
+        """Primo check di un link: se è in ritardo lo spalma su `spread` secondi
+        con una fase fissa per link, così i link con lo stesso intervallo non
+        partono tutti insieme"""
+        interval = self.effective_interval(link_data)
+        last_check = link_data.get('last_check')
+        if last_check:
+            try:
+                elapsed = (datetime.now() - datetime.fromisoformat(last_check)).total_seconds()
+                if elapsed < interval:
+                    return interval - elapsed
+            except ValueError:
+                pass
+        phase = zlib.crc32(f"{user_id}:{link_id}".encode())
+        return phase % max(int(min(interval, spread)), 1)
+    
+    def _schedule_all(self):
+        for uid, udata in self.data['users'].items():
+            for lid, ldata in udata['links'].items():
+                delay = self._initial_delay(uid, lid, ldata, self.effective_interval(ldata))
+                self.scheduler.schedule(uid, lid, delay)
+        logger.info(f"🗓️ {len(self.scheduler)} link pianificati")
+    
+    def reschedule_link(self, user_id, link_id, last_due, error=None):
+        """Ripianifica un link dopo il check mantenendo la sua fase.
         
-        if isinstance(data, dict):
-            if 'items' in data and isinstance(data['items'], list):
-                items = []
-                for item in data['items'][:25]:
-                    if not isinstance(item, dict) or 'id' not in item:
-                        continue
-                    
-                    price = str(item.get('price', '0'))
-                    if 'total_item_price' in item:
-                        price = str(item['total_item_price'])
-                    
-                    photo = None
-                    if 'photo' in item and isinstance(item['photo'], dict):
-                        photo = item['photo'].get('url')
-                    
-                    items.append({
-                        'id': str(item['id']),
-                        'title': item.get('title', 'Articolo')[:120],
-                        'price': price,
-                        'currency': item.get('currency', '€'),
-                        'url': item.get('url', f"https://www.vinted.it/items/{item['id']}"),
-                        'photo': photo
-                    })
-                
-                return items if items else None
-            
-            for value in data.values():
-                result = self._extract_items_from_json(value, depth + 1, max_depth)
-                if result:
-                    return result
+        Se il fetch è fallito (error) il link si riprova prima del suo
+        intervallo, con attesa che raddoppia a ogni errore di fila.
+        """
+        link_data = self.get_user_links(user_id).get(link_id)
+        if not link_data:
+            return  # Rimosso durante il check
+        interval = self.effective_interval(link_data)
+        key = (str(user_id), link_id)
+        if error is None:
+            self._fetch_failures.pop(key, None)
+            next_due = last_due + interval
+            self.scheduler.schedule(user_id, link_id, next_due - time.monotonic())
+            return
+        failures = self._fetch_failures[key] = self._fetch_failures.get(key, 0) + 1
+        delay = min(FETCH_RETRY_DELAY * 2 ** (failures - 1), interval)
+        if error.retry_after:
+            delay = max(delay, error.retry_after)
+        metrics.inc('vinted_check_retries_total')
+        self.scheduler.schedule(user_id, link_id, delay)
+    
+    def interval_bounds(self, link_data):
+        """Limiti (min, max) in secondi del controllo adattivo per un link"""
+        interval = link_data.get('check_interval', 180)
+        lo = link_data.get('min_interval', max(ADAPTIVE_MIN_INTERVAL, interval // 3))
+        hi = link_data.get('max_interval', interval * 3)
+        return max(lo, ADAPTIVE_MIN_INTERVAL), max(hi, lo)
+    
+    def effective_interval(self, link_data):
+        """Intervallo da usare: quello scelto, o quello adattivo se attivo.
         
-        elif isinstance(data, list):
-            for item in data:
-                result = self._extract_items_from_json(item, depth + 1, max_depth)
-                if result:
-                    return result
+        Con il ritmo stimato di nuovi articoli al secondo, l'intervallo è quello
+        che porta in media ADAPTIVE_TARGET_NEW articoli nuovi per check.
+        """
+        interval = link_data.get('check_interval', 180)
+        rate = link_data.get('arrival_rate')
+        if not ADAPTIVE_POLLING or rate is None:
+            return interval
+        lo, hi = self.interval_bounds(link_data)
+        if rate <= 0:
+            return hi
+        return min(max(ADAPTIVE_TARGET_NEW / rate, lo), hi)
+    
+    def set_interval_bounds(self, user_id, link_id, lo, hi):
+        link_data = self.get_user_links(user_id).get(link_id)
+        if not link_data:
+            return False
+        link_data['min_interval'] = lo
+        link_data['max_interval'] = hi
+        self.mark_dirty(user_id, link_id, urgent=True)
+        # I nuovi limiti valgono da subito, non dopo l'attesa già pianificata.
+        # Se il link è in check lo ripianifica il worker con i limiti nuovi
+        if self.scheduler.is_scheduled(user_id, link_id):
+            last = link_data.get('last_check_ts') or time.time()
+            self.scheduler.schedule(user_id, link_id, last + self.effective_interval(link_data) - time.time())
+        return True
+    
+    def _record_check(self, user_id, link_id, link_data, new_count, first):
+        """Aggiorna orario dell'ultimo check e ritmo di arrivo (media esponenziale
+        pesata sul tempo trascorso: check ravvicinati pesano meno)"""
+        now = time.time()
+        previous = link_data.get('last_check_ts')
+        if previous and not first:
+            elapsed = max(now - previous, 1)
+            alpha = 1 - math.exp(-elapsed / ADAPTIVE_WINDOW)
+            observed = new_count / elapsed
+            rate = link_data.get('arrival_rate')
+            link_data['arrival_rate'] = observed if rate is None else rate + alpha * (observed - rate)
+        link_data['last_check_ts'] = now
+        link_data['last_check'] = datetime.now().isoformat()
+        self.mark_dirty(user_id, link_id)
+    
+    def add_user_link(self, user_id, link, name, interval=180):
+        user_id = str(user_id)
+        if user_id not in self.data['users']:
+            self.data['users'][user_id] = {'links': {}}
+        link_id = str(len(self.data['users'][user_id]['links']) + 1)
+        self.data['users'][user_id]['links'][link_id] = {
+            'url': link, 
+            'name': name, 
+            'seen_ids': '',
+            'last_count': 0,
+            'added_at': datetime.now().isoformat(),
+            'check_interval': interval
+        }
+        self.mark_dirty(user_id, link_id, urgent=True)
+        # Primo check entro un minuto, come con il vecchio controllo periodico
+        link_data = self.data['users'][user_id]['links'][link_id]
+        self.scheduler.schedule(user_id, link_id, self._initial_delay(user_id, link_id, link_data, 60))
+        return link_id
+    
+    def remove_user_link(self, user_id, link_id):
+        user_id = str(user_id)
+        if user_id in self.data['users'] and link_id in self.data['users'][user_id]['links']:
+            link_data = self.data['users'][user_id]['links'].pop(link_id)
+            self._seen.pop((user_id, link_id), None)
+            self._fetch_failures.pop((user_id, link_id), None)
+            if self._filters.pop((user_id, link_id), None) is not None:
+                self._invalidate_keywords(normalize_vinted_url(link_data['url']))
+            self.mark_dirty(user_id, link_id, urgent=True)
+            self.scheduler.unschedule(user_id, link_id)
+            return True
+        return False
+    
+    def _link_filter(self, user_id, link_id, link_data):
+        """ItemFilter del link (None se non ha filtri), compilato una volta"""
+        key = (user_id, link_id)
+        if key not in self._filters:
+            rules = link_data.get('filters')
+            self._filters[key] = ItemFilter(rules) if rules else None
+        return self._filters[key]
+    
+    def set_filters(self, user_id, link_id, rules):
+        """Imposta (o toglie, con rules vuoto) i filtri di un link.
         
-        return None
+        Solleva re.error se la regex non è valida.
+        """
+        user_id = str(user_id)
+        link_data = self.get_user_links(user_id)[link_id]
+        compiled = ItemFilter(rules) if rules else None
+        if rules:
+            link_data['filters'] = rules
+        else:
+            link_data.pop('filters', None)
+        self._filters[(user_id, link_id)] = compiled
+        self._invalidate_keywords(normalize_vinted_url(link_data['url']))
+        self.mark_dirty(user_id, link_id, urgent=True)
+    
+    def _invalidate_keywords(self, key):
+        """Parole chiave della ricerca cambiate: via la regex e i dati calcolati con quella"""
+        self._keyword_res.pop(key, None)
+        for cached in [k for k in self._features if k[0] == key]:
+            del self._features[cached]
+    
+    def _keyword_re(self, key):
+        """Un'unica regex con le parole chiave di tutti i link su questa ricerca"""
+        cached = self._keyword_res.get(key)
+        if cached is None:
+            keywords = set()
+            for uid, udata in self.data['users'].items():
+                for lid, ldata in udata['links'].items():
+                    if ldata.get('filters') and normalize_vinted_url(ldata['url']) == key:
+                        keywords |= self._link_filter(uid, lid, ldata).keywords
+            # Lookahead: match vuoto a ogni posizione dove inizia una parola, così
+            # finditer avanza di un carattere e non salta le parole sovrapposte.
+            # Le più lunghe prima, così "nike air" vince su "nike"
+            pattern = '(?=(%s))' % '|'.join(re.escape(k) for k in sorted(keywords, key=len, reverse=True))
+            cached = self._keyword_res[key] = (re.compile(pattern) if keywords else None, frozenset(keywords))
+        return cached
+    
+    def filter_items(self, user_id, link_id, link_data, items, digest):
+        """Applica i filtri del link ai nuovi articoli.
+        
+        I dati degli articoli si calcolano una volta per risultato e si
+        riusano per tutti i link che condividono la stessa ricerca.
+        """
+        item_filter = self._link_filter(user_id, link_id, link_data)
+        if item_filter is None or not items:
+            return items
+        key = normalize_vinted_url(link_data['url'])
+        features = self._features.get((key, digest)) if digest is not None else None
+        if features is None:
+            features = FilterFeatures(*self._keyword_re(key))
+            if digest is not None:
+                self._features[(key, digest)] = features
+                while len(self._features) > PAGE_CACHE_SIZE:
+                    self._features.popitem(last=False)
+        else:
+            self._features.move_to_end((key, digest))
+        with metrics.timer('vinted_filter_seconds'):
+            kept = item_filter.apply(items, features)
+        if len(kept) < len(items):
+            metrics.inc('vinted_filtered_items_total', len(items) - len(kept))
+        return kept
+    
+    def get_user_links(self, user_id):
+        user_id = str(user_id)
+        return self.data['users'].get(user_id, {}).get('links', {})
+    
+    async def fetch_vinted_items_async(self, url, max_age=None):
+        """Articoli di una ricerca (dalla cache condivisa se abbastanza freschi)"""
+        items, _ = await self.fetch_page(url, max_age)
+        return items
+    
+    async def fetch_page(self, url, max_age=None):
+        """Restituisce (items, digest): dal worker del suo shard se lo
+        sharding è attivo, altrimenti dal fetcher locale"""
+        if self.shards is not None and self.shards.ring:
+            return await self.shards.fetch_page(url, max_age)
+        return await self.fetcher.fetch_page(url, max_age)
+    
+    def page_cache_summary(self):
+        return self.fetcher.page_cache_summary()
     
-    def check_new_items(self, user_id, link_id):
+    def parse_vinted_page(self, body, url=''):
+        return self.fetcher.parse_vinted_page(body, url)
+    
+    async def close(self):
+        await self.fetcher.close()
+    
+    def _seen_ids(self, user_id, link_id, link_data):
+        """SeenIds del link, decodificato una volta e poi tenuto in memoria"""
+        seen = self._seen.get((user_id, link_id))
+        if seen is None:
+            seen = SeenIds(link_data.get('seen_ids'))
+            if 'last_items' in link_data:
+                # Vecchio formato: gli articoli salvati interi diventano solo id
+                old = link_data.pop('last_items')
+                seen.add_many(i['id'] for i in old)
+                link_data['seen_ids'] = seen.encode()
+                link_data.setdefault('last_count', len(old))
+            self._seen[(user_id, link_id)] = seen
+        return seen
+    
+    async def check_new_items(self, user_id, link_id):
         user_id = str(user_id)
         if user_id not in self.data['users']:
             return []
@@ -277,28 +2065,307 @@ class VintedMonitor:
             return []
         
         logger.info(f"🔍 Check link #{link_id}: {link_data['name']}")
-        current = self.fetch_vinted_items(link_data['url'])
+        current, digest = await self.fetch_page(link_data['url'])
         
         if not current:
             return []
         
-        current_ids = {i['id'] for i in current}
-        last_ids = {i['id'] for i in link_data['last_items']}
-        new_ids = current_ids - last_ids
-        new_items = [i for i in current if i['id'] in new_ids]
+        if digest is not None and digest == link_data.get('last_digest'):
+            # Pagina identica all'ultimo check di questo link: niente da confrontare
+            self._record_check(user_id, link_id, link_data, 0, first=False)
+            return []
+        
+        with metrics.timer('vinted_diff_seconds'):
+            seen = self._seen_ids(user_id, link_id, link_data)
+            # Al primo check tutto è "nuovo": non conta per il ritmo di arrivo
+            first = len(seen) == 0
+            new_items = seen.new_items(current)
+            
+            if new_items:
+                seen.add_many(i['id'] for i in new_items)
+                link_data['seen_ids'] = seen.encode()
         
+        # Il ritmo di arrivo conta tutti i nuovi articoli, anche quelli filtrati
+        arrivals = len(new_items)
         if new_items:
             logger.info(f"🆕 {len(new_items)} nuovi articoli!")
+            metrics.inc('vinted_new_items_total', len(new_items))
+            # Già segnati come visti: quelli scartati dal filtro non tornano più
+            new_items = self.filter_items(user_id, link_id, link_data, new_items, digest)
         
-        link_data['last_items'] = current
-        link_data['last_check'] = datetime.now().isoformat()
-        self.save_data()
+        link_data['last_count'] = len(current)
+        link_data['last_digest'] = digest
+        self._record_check(user_id, link_id, link_data, arrivals, first)
         
         return new_items
 
-monitor = VintedMonitor()
+# I processi worker (sharding) reimportano questo file: solo il processo
+# principale apre il database e pianifica i link
+monitor = VintedMonitor() if multiprocessing.parent_process() is None else None
+
+class RateLimiter:
+    """Prenota gli slot di invio: prima quello della chat, poi quello globale"""
+    
+    def __init__(self, global_rate=NOTIFY_GLOBAL_RATE, chat_interval=NOTIFY_CHAT_INTERVAL):
+        self.global_interval = 1 / global_rate
+        self.chat_interval = chat_interval
+        self._next_global = 0.0
+        self._next_chat = {}
+    
+    async def acquire(self, chat_id, cost=1):
+        """cost: messaggi che conterà Telegram (un album da N foto ne conta N)"""
+        now = time.monotonic()
+        at = max(now, self._next_chat.get(chat_id, 0))
+        self._next_chat[chat_id] = at + self.chat_interval * cost
+        if at > now:
+            await asyncio.sleep(at - now)
+        
+        now = time.monotonic()
+        at = max(now, self._next_global)
+        self._next_global = at + self.global_interval * cost
+        if at > now:
+            await asyncio.sleep(at - now)
+        
+        if len(self._next_chat) > 10000:
+            self._next_chat = {c: t for c, t in self._next_chat.items() if t > now}
+    
+    def pause(self, chat_id, seconds):
+        """Dopo un RetryAfter: niente invii a quella chat per `seconds`"""
+        until = time.monotonic() + seconds
+        self._next_chat[chat_id] = max(self._next_chat.get(chat_id, 0), until)
+
+class PhotoCache:
+    """URL della foto -> file_id restituito da Telegram al primo invio riuscito.
+    
+    Con il file_id Telegram non riscarica l'immagine da Vinted: gli invii
+    successivi (altre chat, /test) sono più veloci e falliscono meno.
+    """
+    
+    def __init__(self, size=PHOTO_CACHE_SIZE, ttl=PHOTO_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def get(self, url):
+        entry = self._entries.get(url)
+        if entry is not None and time.monotonic() - entry[1] < self.ttl:
+            self._entries.move_to_end(url)
+            self.hits += 1
+            metrics.inc('vinted_photo_cache_total', result='hit')
+            return entry[0]
+        if entry is not None:
+            del self._entries[url]
+        self.misses += 1
+        metrics.inc('vinted_photo_cache_total', result='miss')
+        return None
+    
+    def put(self, url, message):
+        """Salva il file_id della foto più grande del messaggio inviato"""
+        photo = getattr(message, 'photo', None)
+        if not photo:
+            return
+        self._entries[url] = (photo[-1].file_id, time.monotonic())
+        self._entries.move_to_end(url)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+    
+    def forget(self, url):
+        if self._entries.pop(url, None) is not None:
+            metrics.inc('vinted_photo_cache_total', result='rejected')
+    
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+    
+    async def send(self, send, url, **kwargs):
+        """send(foto, **kwargs) con il file_id se è noto, altrimenti con l'URL.
+        
+        Se Telegram rifiuta il file_id lo si dimentica e si riprova con l'URL.
+        """
+        file_id = self.get(url)
+        if file_id is not None:
+            try:
+                return await send(file_id, **kwargs)
+            except BadRequest:
+                self.forget(url)
+        message = await send(url, **kwargs)
+        self.put(url, message)
+        return message
+
+photo_cache = PhotoCache()
+
+class NotificationDispatcher:
+    """Coda delle notifiche con worker propri: i check non aspettano Telegram"""
+    
+    def __init__(self, workers=NOTIFY_WORKERS):
+        self.workers = workers
+        self.queue = asyncio.Queue()
+        self.limiter = RateLimiter()
+        self.bot = None
+        self._tasks = []
+        self.sent = 0
+        self.failed = 0
+    
+    def _count(self, result, n=1):
+        if result == 'sent':
+            self.sent += n
+        else:
+            self.failed += n
+        metrics.inc('vinted_notifications_total', n, result=result)
+    
+    def start(self, bot):
+        self.bot = bot
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+    
+    async def stop(self, timeout=10):
+        """Prova a svuotare la coda, poi ferma i worker"""
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"⚠️ {self.queue.qsize()} notifiche non inviate allo spegnimento")
+        for task in self._tasks:
+            task.cancel()
+    
+    def notify(self, chat_id, items, search_name):
+        """Accoda i nuovi articoli di una ricerca per una chat"""
+        self.queue.put_nowait((chat_id, items, search_name))
+    
+    async def _worker(self):
+        while True:
+            chat_id, items, search_name = await self.queue.get()
+            try:
+                # Comprende anche l'attesa del rate limit: è tempo che l'utente aspetta
+                with metrics.timer('vinted_notify_seconds'):
+                    if len(items) >= NOTIFY_GROUP_THRESHOLD:
+                        await self._deliver_grouped(chat_id, items, search_name)
+                    else:
+                        for item in items:
+                            await self._deliver_item(chat_id, item, search_name)
+            except Exception as e:
+                logger.error(f"❌ Errore notifica: {e}")
+            finally:
+                self.queue.task_done()
+    
+    async def _send(self, chat_id, method, *args, cost=1, **kwargs):
+        """Invio con rate limit e retry: attende su RetryAfter, backoff sugli errori di rete"""
+        retries = max(1, NOTIFY_MAX_RETRIES)
+        last_error = None
+        for attempt in range(retries):
+            await self.limiter.acquire(chat_id, cost)
+            try:
+                return await method(chat_id, *args, **kwargs)
+            except RetryAfter as e:
+                logger.warning(f"⏳ Flood control: attendo {e.retry_after}s per {chat_id}")
+                metrics.inc('vinted_notify_retries_total', reason='retry_after')
+                self.limiter.pause(chat_id, e.retry_after)
+                last_error = e
+            except BadRequest:
+                raise  # Richiesta sbagliata (es. foto non valida): riprovare non serve
+            except NetworkError as e:
+                if attempt == retries - 1:
+                    raise
+                delay = min(2 ** attempt, 30)
+                metrics.inc('vinted_notify_retries_total', reason='network')
+                logger.warning(f"⚠️ Errore di rete ({e}), riprovo tra {delay}s")
+                await asyncio.sleep(delay)
+        # Solo RetryAfter fino all'ultimo tentativo
+        raise TelegramError(f"Flood control su {chat_id} dopo {retries} tentativi") from last_error
+    
+    async def _deliver_item(self, chat_id, item, search_name):
+        caption = (
+            f"🆕 <b>NUOVO ARTICOLO TROVATO!</b>\n\n"
+            f"<b>{item['title']}</b>\n\n"
+            f"💰 <b>Prezzo:</b> {item['price']} €\n"
+            f"🔗 <a href='{item['url']}'>Vedi su Vinted</a>\n\n"
+            f"━━━━━━━━━━━━━━━━━━━━\n"
+            f"📋 Ricerca: <i>{search_name}</i>"
+        )
+        try:
+            if item['photo'] and 'http' in item['photo']:
+                try:
+                    await photo_cache.send(
+                        partial(self._send, chat_id, self.bot.send_photo),
+                        item['photo'], caption=caption, parse_mode='HTML'
+                    )
+                except BadRequest:
+                    # Telegram non riesce a scaricare la foto: mandiamo solo il testo
+                    await self._send(chat_id, self.bot.send_message, caption, parse_mode='HTML')
+            else:
+                await self._send(chat_id, self.bot.send_message, caption, parse_mode='HTML')
+            self._count('sent')
+            logger.info(f"✅ Notifica inviata a {chat_id}")
+        except Exception as e:
+            self._count('failed')
+            logger.error(f"❌ Errore notifica: {e}")
+    
+    async def _deliver_grouped(self, chat_id, items, search_name):
+        """Tanti articoli insieme: album da max 10 foto, il resto in un riepilogo"""
+        with_photo = [i for i in items if i['photo'] and 'http' in i['photo']]
+        summary = [i for i in items if not (i['photo'] and 'http' in i['photo'])]
+        
+        for start in range(0, len(with_photo), 10):
+            chunk = with_photo[start:start + 10]
+            file_ids = [photo_cache.get(item['photo']) for item in chunk]
+            media = [
+                InputMediaPhoto(
+                    file_id or item['photo'],
+                    caption=f"<b>{item['title']}</b>\n💰 {item['price']} €\n🔗 <a href='{item['url']}'>Vedi su Vinted</a>",
+                    parse_mode='HTML'
+                )
+                for item, file_id in zip(chunk, file_ids)
+            ]
+            try:
+                messages = await self._send(chat_id, self.bot.send_media_group, media, cost=len(media))
+                for item, message in zip(chunk, messages):
+                    photo_cache.put(item['photo'], message)
+                self._count('sent', len(chunk))
+            except Exception as e:
+                if isinstance(e, BadRequest):
+                    # Non si sa quale file_id abbia rifiutato: si dimenticano tutti quelli usati
+                    for item, file_id in zip(chunk, file_ids):
+                        if file_id:
+                            photo_cache.forget(item['photo'])
+                logger.warning(f"⚠️ Album non inviato ({e}), passo al riepilogo")
+                summary.extend(chunk)
+        
+        if summary:
+            await self._deliver_summary(chat_id, summary, search_name, len(items))
+        logger.info(f"✅ {len(items)} articoli inviati a {chat_id}")
+    
+    async def _deliver_summary(self, chat_id, items, search_name, total):
+        header = (
+            f"🆕 <b>{total} NUOVI ARTICOLI!</b>\n"
+            f"📋 Ricerca: <i>{search_name}</i>\n"
+            f"━━━━━━━━━━━━━━━━━━━━\n"
+        )
+        lines = [f"• <a href='{i['url']}'>{i['title']}</a> — {i['price']} €" for i in items]
+        # Un messaggio Telegram ha al massimo 4096 caratteri
+        messages, current = [], header
+        for line in lines:
+            if len(current) + len(line) + 1 > 4000:
+                messages.append(current)
+                current = ''
+            current += line + '\n'
+        messages.append(current)
+        for text in messages:
+            try:
+                await self._send(chat_id, self.bot.send_message, text, parse_mode='HTML', disable_web_page_preview=True)
+            except Exception as e:
+                self._count('failed', len(items))
+                logger.error(f"❌ Errore notifica: {e}")
+                return
+        self._count('sent', len(items))
+
+dispatcher = NotificationDispatcher()
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /adattivo solo se il controllo adattivo è attivo
+    adaptive = "  /adattivo - ⚡ Intervallo adattivo\n" if ADAPTIVE_POLLING else ""
     await update.message.reply_text(
         "🛍️ <b>Benvenuto su Vinted Alert Bot!</b>\n\n"
         "🔔 Ti avviso quando compaiono nuovi articoli!\n\n"
@@ -307,7 +2374,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "  /aggiungi - 🔗 Aggiungi ricerca\n"
         "  /lista - 📜 Vedi i tuoi link\n"
         "  /test - 🔍 Test immediato\n"
-        "  /rimuovi - 🗑️ Elimina link\n\n"
+        "  /rimuovi - 🗑️ Elimina link\n"
+        "  /filtri - 🎯 Filtra gli articoli\n"
+        f"{adaptive}\n"
         "━━━━━━━━━━━━━━━━━━━━\n"
         "⏱️ Controllo ogni 3 minuti\n"
         "🚀 Pronto ad iniziare!",
@@ -341,8 +2410,13 @@ async def lista(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if last_check != 'Mai':
             last_check = last_check[11:16]
         msg += f"🔹 <b>#{lid}</b> • {d['name']}\n"
-        msg += f"   📦 {len(d.get('last_items', []))} articoli trovati\n"
-        msg += f"   🕐 Ultimo check: {last_check}\n\n"
+        msg += f"   📦 {d.get('last_count', len(d.get('last_items', [])))} articoli trovati\n"
+        msg += f"   🕐 Ultimo check: {last_check}\n"
+        if d.get('filters'):
+            msg += f"   🎯 {describe_filters(d['filters'])}\n"
+        if ADAPTIVE_POLLING and d.get('arrival_rate') is not None:
+            msg += f"   ⚡ Controllo ogni {monitor.effective_interval(d) / 60:.1f} min (adattivo)\n"
+        msg += "\n"
     
     msg += "━━━━━━━━━━━━━━━━━━━━\n"
     msg += "💡 Usa /test per vedere gli articoli\n"
@@ -350,6 +2424,26 @@ async def lista(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(msg, parse_mode='HTML')
 
+async def send_item_preview(message, item, caption):
+    """Risponde con l'anteprima di un articolo rispettando il ritmo della chat"""
+    await dispatcher.limiter.acquire(message.chat_id)
+    try:
+        if item['photo'] and 'http' in item['photo']:
+            await photo_cache.send(message.reply_photo, item['photo'], caption=caption, parse_mode='HTML')
+        else:
+            await message.reply_text(caption, parse_mode='HTML')
+    except Exception:
+        await message.reply_text(caption, parse_mode='HTML')
+
+async def _fetch_for_preview(data):
+    """(link, articoli, errore) per /test, riusando i risultati freschi del checker"""
+    try:
+        items = await monitor.fetch_vinted_items_async(data['url'], max_age=INTERACTIVE_CACHE_TTL)
+    except Exception as e:
+        logger.error(f"❌ Errore test {data['url']}: {e}")
+        return data, [], e
+    return data, items, None
+
 async def test_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
     links = monitor.get_user_links(update.effective_user.id)
     if not links:
@@ -358,10 +2452,17 @@ async def test_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text("🔍 <b>Sto cercando articoli...</b>", parse_mode='HTML')
     
-    for lid, data in links.items():
-        items = monitor.fetch_vinted_items(data['url'])
+    # Tutti i link partono insieme: ogni risultato si invia appena è pronto
+    pending = [_fetch_for_preview(data) for data in links.values()]
+    for next_done in asyncio.as_completed(pending):
+        data, items, error = await next_done
         
-        if items:
+        if error is not None:
+            await update.message.reply_text(
+                f"⚠️ <b>{data['name']}</b>\n\nVinted non risponde, riprova tra poco",
+                parse_mode='HTML'
+            )
+        elif items:
             await update.message.reply_text(
                 f"✅ <b>{data['name']}</b>\n\n"
                 f"📦 Trovati {len(items)} articoli!\n"
@@ -377,22 +2478,187 @@ async def test_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     f"━━━━━━━━━━━━━━━━━━━━\n"
                     f"📍 Articolo {i} di {min(5, len(items))}"
                 )
-                
-                try:
-                    if item['photo'] and 'http' in item['photo']:
-                        await update.message.reply_photo(item['photo'], caption=caption, parse_mode='HTML')
-                    else:
-                        await update.message.reply_text(caption, parse_mode='HTML')
-                except:
-                    await update.message.reply_text(caption, parse_mode='HTML')
-                
-                await asyncio.sleep(0.8)
+                await send_item_preview(update.message, item, caption)
         else:
             await update.message.reply_text(
                 f"⚠️ <b>{data['name']}</b>\n\nNessun articolo trovato al momento",
                 parse_mode='HTML'
             )
 
+async def adattivo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not ADAPTIVE_POLLING:
+        await update.message.reply_text("⚠️ Il controllo adattivo non è attivo su questo bot")
+        return
+    
+    user_id = update.effective_user.id
+    links = monitor.get_user_links(user_id)
+    args = context.args or []
+    lid = args[0].lstrip('#') if args else None
+    
+    if len(args) != 3 or lid not in links:
+        await update.message.reply_text(
+            "⚡ <b>Controllo adattivo</b>\n\n"
+            "Le ricerche con tanti nuovi articoli vengono controllate più spesso, "
+            "quelle ferme più di rado, sempre entro i limiti che scegli tu.\n\n"
+            "📝 <b>Formato:</b>\n"
+            "<code>/adattivo ID MIN MAX</code> (minuti)\n\n"
+            "💡 <b>Esempio:</b>\n"
+            "<code>/adattivo 1 2 30</code>",
+            parse_mode='HTML'
+        )
+        return
+    
+    try:
+        lo, hi = int(args[1]), int(args[2])
+    except ValueError:
+        await update.message.reply_text("❌ MIN e MAX devono essere numeri!")
+        return
+    if lo < max(1, ADAPTIVE_MIN_INTERVAL // 60) or hi < lo or hi > 24 * 60:
+        await update.message.reply_text(
+            f"❌ Serve {max(1, ADAPTIVE_MIN_INTERVAL // 60)} ≤ MIN ≤ MAX ≤ {24 * 60} minuti!"
+        )
+        return
+    
+    monitor.set_interval_bounds(user_id, lid, lo * 60, hi * 60)
+    await update.message.reply_text(
+        f"✅ <b>#{lid} • {links[lid]['name']}</b>\n\n"
+        f"⚡ Controllo adattivo tra {lo} e {hi} minuti",
+        parse_mode='HTML'
+    )
+
+def _timing_line(label, name, **labels):
+    hist = metrics.histogram(name, **labels)
+    if not hist or not hist['count']:
+        return f"  {label}: —"
+    avg = hist['sum'] / hist['count'] * 1000
+    return f"  {label}: {avg:.1f} ms medi, max {hist['max'] * 1000:.1f} ms ({hist['count']})"
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Riepilogo delle metriche, solo per gli utenti in ADMIN_IDS"""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    
+    statuses = metrics.counter_by('vinted_fetch_status_total', 'code')
+    methods = metrics.counter_by('vinted_extraction_total', 'method')
+    cache = monitor.page_cache_summary()
+    paths = monitor.parser.path_index_stats()
+    lag = metrics.histogram('vinted_scheduler_lag_seconds')
+    
+    await update.message.reply_text(
+        "📈 <b>Statistiche</b>\n\n"
+        "⏱️ <b>Tempi:</b>\n"
+        f"{_timing_line('fetch', 'vinted_fetch_seconds')}\n"
+        f"{_timing_line('parse JSON', 'vinted_parse_seconds', path='json')}\n"
+        f"{_timing_line('parse HTML', 'vinted_parse_seconds', path='html')}\n"
+        f"{_timing_line('parse API', 'vinted_parse_seconds', path='api')}\n"
+        f"{_timing_line('diff', 'vinted_diff_seconds')}\n"
+        f"{_timing_line('salvataggio', 'vinted_save_seconds')}\n"
+        f"{_timing_line('notifica', 'vinted_notify_seconds')}\n\n"
+        f"🌐 <b>Status:</b> {', '.join(f'{k}: {v}' for k, v in sorted(statuses.items())) or '—'}\n"
+        f"🧩 <b>Estrazione:</b> {', '.join(f'{k}: {v}' for k, v in sorted(methods.items())) or '—'}\n"
+        f"🗂️ <b>Cache pagine:</b> hit rate {cache['hit_rate']:.0%} su {cache['entries']} ricerche\n"
+        f"🧭 <b>Indice percorsi:</b> "
+        f"{'nei processi shard' if monitor.shards else '{hits} hit, {misses} miss, {paths} percorsi'.format(**paths)}\n"
+        f"🖼️ <b>Cache foto:</b> hit rate {photo_cache.hit_rate():.0%} su {len(photo_cache)} foto\n\n"
+        f"🆕 Nuovi articoli: {metrics.counter('vinted_new_items_total')}\n"
+        f"📨 Notifiche: {dispatcher.sent} inviate, {dispatcher.failed} fallite, "
+        f"{dispatcher.queue.qsize()} in coda\n"
+        f"🗓️ Ritardo scheduler: "
+        + (f"{lag['sum'] / lag['count']:.1f}s medio, max {lag['max']:.1f}s" if lag and lag['count'] else "—"),
+        parse_mode='HTML'
+    )
+
+def parse_filter_args(args):
+    """['min=10', 'include=nike,adidas', ...] -> regole; ValueError se non valide.
+    
+    regex va per ultima: tutto quello che segue fa parte del pattern.
+    """
+    rules = {}
+    for i, arg in enumerate(args):
+        key, sep, value = arg.partition('=')
+        key = key.lower()
+        if not sep:
+            raise ValueError(arg)
+        if key == 'regex':
+            rules['regex'] = ' '.join([value, *args[i + 1:]]).strip()
+            break
+        if key in ('min', 'max'):
+            rules[key] = float(value.replace(',', '.'))
+        elif key in ('include', 'exclude'):
+            rules[key] = [k.strip() for k in value.split(',') if k.strip()]
+        elif key == 'foto':
+            rules[key] = int(value)
+            if rules[key] < 0:
+                raise ValueError(arg)
+        else:
+            raise ValueError(arg)
+    return rules
+
+def describe_filters(rules):
+    parts = []
+    if 'min' in rules or 'max' in rules:
+        parts.append(f"💰 {rules.get('min', 0):g}–{rules['max']:g} €" if 'max' in rules else f"💰 da {rules['min']:g} €")
+    if rules.get('include'):
+        parts.append(f"✅ {html_escape(', '.join(rules['include']))}")
+    if rules.get('exclude'):
+        parts.append(f"🚫 {html_escape(', '.join(rules['exclude']))}")
+    if rules.get('regex'):
+        parts.append(f"🔎 <code>{html_escape(rules['regex'])}</code>")
+    if 'foto' in rules:
+        parts.append(f"📷 max {rules['foto']} senza foto")
+    return ' • '.join(parts)
+
+async def filtri(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    links = monitor.get_user_links(user_id)
+    args = context.args or []
+    lid = args[0].lstrip('#') if args else None
+    
+    if lid not in links:
+        await update.message.reply_text(
+            "🎯 <b>Filtri</b>\n\n"
+            "Ricevi solo gli articoli che ti interessano davvero.\n\n"
+            "📝 <b>Formato:</b>\n"
+            "<code>/filtri ID regola=valore ...</code>\n\n"
+            "  <code>min=10 max=80</code> - prezzo\n"
+            "  <code>include=nike,adidas</code> - almeno una parola nel titolo\n"
+            "  <code>exclude=rotto,difetto</code> - nessuna di queste parole\n"
+            "  <code>foto=0</code> - articoli senza foto per check\n"
+            "  <code>regex=...</code> - espressione sul titolo (per ultima)\n\n"
+            "<code>/filtri ID</code> mostra i filtri, <code>/filtri ID reset</code> li toglie",
+            parse_mode='HTML'
+        )
+        return
+    
+    rules = dict(links[lid].get('filters') or {})
+    if len(args) == 2 and args[1].lower() == 'reset':
+        rules = {}
+    elif len(args) > 1:
+        try:
+            rules.update(parse_filter_args(args[1:]))
+        except ValueError as e:
+            await update.message.reply_text(f"❌ Regola non valida: <code>{html_escape(str(e))}</code>", parse_mode='HTML')
+            return
+        if 'min' in rules and 'max' in rules and rules['min'] > rules['max']:
+            await update.message.reply_text("❌ min deve essere minore di max!")
+            return
+    else:
+        await update.message.reply_text(
+            f"🎯 <b>#{lid} • {links[lid]['name']}</b>\n\n{describe_filters(rules) or 'Nessun filtro'}",
+            parse_mode='HTML'
+        )
+        return
+    
+    try:
+        monitor.set_filters(user_id, lid, rules)
+    except re.error as e:
+        await update.message.reply_text(f"❌ Regex non valida: {e}")
+        return
+    await update.message.reply_text(
+        f"✅ <b>#{lid} • {links[lid]['name']}</b>\n\n🎯 {describe_filters(rules) or 'Filtri rimossi'}",
+        parse_mode='HTML'
+    )
+
 async def rimuovi(update: Update, context: ContextTypes.DEFAULT_TYPE):
     links = monitor.get_user_links(update.effective_user.id)
     if not links:
@@ -408,6 +2674,39 @@ async def rimuovi(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='HTML'
     )
 
+async def add_link_with_preview(user_id, url, name, interval, edit_status, message):
+    """Verifica il link, lo aggiunge e mostra le prime anteprime.
+    
+    Usato sia dal pulsante dell'intervallo sia dal numero scritto a mano;
+    edit_status aggiorna il messaggio "Verifico il link..." già inviato.
+    """
+    try:
+        items = await monitor.fetch_vinted_items_async(url, max_age=INTERACTIVE_CACHE_TTL)
+        found = str(len(items))
+    except FetchError:
+        # Il link si aggiunge lo stesso: lo scheduler lo riproverà
+        items, found = [], "non verificabili ora"
+    link_id = monitor.add_user_link(user_id, url, name, interval * 60)
+    
+    await edit_status(
+        f"✅ <b>Link aggiunto con successo!</b>\n\n"
+        f"🏷️ <b>Nome:</b> {name}\n"
+        f"🆔 <b>ID:</b> #{link_id}\n"
+        f"📦 <b>Articoli:</b> {found}\n"
+        f"⏱️ <b>Controllo ogni:</b> {interval} minuti\n"
+        f"━━━━━━━━━━━━━━━━━━━━\n"
+        f"🔔 Ti avviserò per nuovi articoli!",
+        parse_mode='HTML'
+    )
+    
+    for item in items[:3]:
+        caption = (
+            f"<b>{item['title']}</b>\n\n"
+            f"💰 <b>Prezzo:</b> {item['price']} €\n"
+            f"🔗 <a href='{item['url']}'>Vedi su Vinted</a>"
+        )
+        await send_item_preview(message, item, caption)
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
     user_id = update.effective_user.id
@@ -425,38 +2724,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             name = context.user_data.get('temp_name')
             
             msg = await update.message.reply_text("🔍 <b>Verifico il link...</b>", parse_mode='HTML')
-            
-            items = monitor.fetch_vinted_items(url)
-            link_id = monitor.add_user_link(user_id, url, name, interval * 60)
-            
-            await msg.edit_text(
-                f"✅ <b>Link aggiunto con successo!</b>\n\n"
-                f"🏷️ <b>Nome:</b> {name}\n"
-                f"🆔 <b>ID:</b> #{link_id}\n"
-                f"📦 <b>Articoli:</b> {len(items)}\n"
-                f"⏱️ <b>Controllo ogni:</b> {interval} minuti\n"
-                f"━━━━━━━━━━━━━━━━━━━━\n"
-                f"🔔 Ti avviserò per nuovi articoli!",
-                parse_mode='HTML'
-            )
-            
-            if items:
-                for i, item in enumerate(items[:3], 1):
-                    caption = (
-                        f"<b>{item['title']}</b>\n\n"
-                        f"💰 <b>Prezzo:</b> {item['price']} €\n"
-                        f"🔗 <a href='{item['url']}'>Vedi su Vinted</a>"
-                    )
-                    
-                    try:
-                        if item['photo'] and 'http' in item['photo']:
-                            await update.message.reply_photo(item['photo'], caption=caption, parse_mode='HTML')
-                        else:
-                            await update.message.reply_text(caption, parse_mode='HTML')
-                    except:
-                        await update.message.reply_text(caption, parse_mode='HTML')
-                    
-                    await asyncio.sleep(0.5)
+            await add_link_with_preview(user_id, url, name, interval, msg.edit_text, update.message)
             
             # Pulisci i dati temporanei
             context.user_data.clear()
@@ -512,39 +2780,10 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         name = context.user_data.get('temp_name')
         
         await query.edit_message_text("🔍 <b>Verifico il link...</b>", parse_mode='HTML')
-        
-        items = monitor.fetch_vinted_items(url)
-        link_id = monitor.add_user_link(query.from_user.id, url, name, interval * 60)
-        
-        await query.edit_message_text(
-            f"✅ <b>Link aggiunto con successo!</b>\n\n"
-            f"🏷️ <b>Nome:</b> {name}\n"
-            f"🆔 <b>ID:</b> #{link_id}\n"
-            f"📦 <b>Articoli:</b> {len(items)}\n"
-            f"⏱️ <b>Controllo ogni:</b> {interval} minuti\n"
-            f"━━━━━━━━━━━━━━━━━━━━\n"
-            f"🔔 Ti avviserò per nuovi articoli!",
-            parse_mode='HTML'
+        await add_link_with_preview(
+            query.from_user.id, url, name, interval, query.edit_message_text, query.message
         )
         
-        if items:
-            for i, item in enumerate(items[:3], 1):
-                caption = (
-                    f"<b>{item['title']}</b>\n\n"
-                    f"💰 <b>Prezzo:</b> {item['price']} €\n"
-                    f"🔗 <a href='{item['url']}'>Vedi</a>"
-                )
-                
-                try:
-                    if item['photo'] and 'http' in item['photo']:
-                        await query.message.reply_photo(item['photo'], caption=caption, parse_mode='HTML')
-                    else:
-                        await query.message.reply_text(caption, parse_mode='HTML')
-                except:
-                    await query.message.reply_text(caption, parse_mode='HTML')
-                
-                await asyncio.sleep(0.5)
-        
         context.user_data.clear()
         
     elif query.data.startswith('remove_'):
@@ -556,56 +2795,150 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 parse_mode='HTML'
             )
 
-async def check_updates(context: ContextTypes.DEFAULT_TYPE):
-    logger.info("━━━━━━ 🔍 CONTROLLO PERIODICO ━━━━━━")
-    current_time = datetime.now()
+async def check_link(uid, lid):
+    """Controlla un singolo link e passa i nuovi articoli al dispatcher"""
+    ldata = monitor.get_user_links(uid).get(lid)
+    if not ldata:
+        return
     
-    for uid, udata in monitor.data['users'].items():
-        for lid, ldata in udata['links'].items():
-            try:
-                # Controlla se è ora di fare il check per questo link
-                interval = ldata.get('check_interval', 180)
-                last_check = ldata.get('last_check')
-                
-                if last_check:
-                    last_dt = datetime.fromisoformat(last_check)
-                    seconds_passed = (current_time - last_dt).total_seconds()
-                    
-                    if seconds_passed < interval:
-                        continue  # Non ancora tempo
-                
-                new = monitor.check_new_items(uid, lid)
-                
-                for item in new:
-                    caption = (
-                        f"🆕 <b>NUOVO ARTICOLO TROVATO!</b>\n\n"
-                        f"<b>{item['title']}</b>\n\n"
-                        f"💰 <b>Prezzo:</b> {item['price']} €\n"
-                        f"🔗 <a href='{item['url']}'>Vedi su Vinted</a>\n\n"
-                        f"━━━━━━━━━━━━━━━━━━━━\n"
-                        f"📋 Ricerca: <i>{ldata['name']}</i>"
-                    )
-                    
-                    try:
-                        if item['photo'] and 'http' in item['photo']:
-                            await context.bot.send_photo(
-                                int(uid),
-                                item['photo'],
-                                caption=caption,
-                                parse_mode='HTML'
-                            )
-                        else:
-                            await context.bot.send_message(int(uid), caption, parse_mode='HTML')
-                        
-                        logger.info(f"✅ Notifica inviata a {uid}")
-                    except Exception as e:
-                        logger.error(f"❌ Errore notifica: {e}")
-                
-                await asyncio.sleep(2)
-            except Exception as e:
-                logger.error(f"❌ Errore check: {e}")
+    with metrics.timer('vinted_check_seconds'):
+        new = await monitor.check_new_items(uid, lid)
+    
+    if new:
+        dispatcher.notify(int(uid), new, ldata['name'])
+
+async def check_worker(queue):
+    """Worker del pool: controlla i link scaduti e li ripianifica"""
+    while True:
+        (uid, lid), due = await queue.get()
+        # Ritardo rispetto alla scadenza: intervallo reale meno quello configurato
+        lag = time.monotonic() - due
+        metrics.observe('vinted_scheduler_lag_seconds', lag)
+        metrics.set('vinted_scheduler_last_lag_seconds', round(lag, 3))
+        error = None
+        try:
+            await check_link(uid, lid)
+        except FetchError as e:
+            # Non è "nessun articolo": il link va ricontrollato presto
+            error = e
+            logger.warning(f"⚠️ Link #{lid} non controllato ({e}), lo riprovo")
+        except Exception as e:
+            logger.error(f"❌ Errore check: {e}")
+        finally:
+            monitor.reschedule_link(uid, lid, due, error)
+            queue.task_done()
+
+async def run_scheduler():
+    """Loop dei controlli: si sveglia solo quando scade il prossimo link.
+    
+    Un link torna nel heap solo a check finito, quindi non può mai essere
+    controllato due volte in parallelo.
+    """
+    queue = asyncio.Queue()
+    metrics.set('vinted_check_queue_size', queue.qsize)
+    workers = [asyncio.create_task(check_worker(queue)) for _ in range(CHECK_WORKERS)]
+    logger.info(f"⚙️ Scheduler avviato con {CHECK_WORKERS} worker")
+    try:
+        while True:
+            await monitor.scheduler.wait()
+            for entry in monitor.scheduler.pop_due():
+                queue.put_nowait(entry)
+    finally:
+        for w in workers:
+            w.cancel()
+
+def register_gauges():
+    """Gauge letti al momento della richiesta delle metriche"""
+    metrics.set('vinted_links', lambda: sum(len(u['links']) for u in monitor.data['users'].values()))
+    metrics.set('vinted_scheduled_links', lambda: len(monitor.scheduler))
+    metrics.set('vinted_notify_queue_size', dispatcher.queue.qsize)
+    metrics.set('vinted_dirty_links', lambda: len(monitor._dirty))
+    metrics.set('vinted_page_cache_entries', lambda: len(monitor.fetcher._fetch_cache))
+    for kind in monitor.fetcher.cache_stats:
+        metrics.set('vinted_page_cache_results', lambda kind=kind: monitor.fetcher.cache_stats[kind], result=kind)
+    # Con SHARD_WORKERS il parsing avviene nei processi shard e questi restano a 0
+    metrics.set('vinted_path_index_hits', lambda: monitor.parser.path_hits)
+    metrics.set('vinted_path_index_misses', lambda: monitor.parser.path_misses)
+    metrics.set('vinted_path_index_paths', lambda: len(monitor.parser.item_paths))
+    metrics.set('vinted_photo_cache_entries', lambda: len(photo_cache))
+    metrics.set('vinted_parse_inflight', lambda: monitor.fetcher.parse_inflight)
+    metrics.set('vinted_shard_workers', lambda: len(monitor.shards.workers) if monitor.shards else 0)
+
+def is_ready(app):
+    """Pronto se l'applicazione gira e scheduler e flusher sono vivi"""
+    tasks = [app.bot_data.get(name) for name in ('scheduler_task', 'flusher_task')]
+    return app.running and all(task is not None and not task.done() for task in tasks)
+
+def install_webhook_routes(app):
+    """Aggiunge /healthz e /readyz al server webhook di python-telegram-bot.
+    
+    Servono sulla porta pubblica ($PORT) perché è lì che Railway fa il
+    healthcheck; con METRICS_PORT le stesse route ci sono anche sul server
+    delle metriche. PTB non ha un'opzione per altre route: si estende la
+    classe dell'app tornado che l'Updater crea in start_webhook, interna a
+    PTB (versione fissata in requirements.txt). Se non c'è più si solleva
+    RuntimeError all'avvio invece di perdere le route in silenzio.
+    Import locali perché tornado c'è solo con l'extra [webhooks].
+    """
+    import tornado.web
+    from telegram.ext import _updater
+    
+    base = getattr(_updater, 'WebhookAppClass', None)
+    if not (isinstance(base, type) and issubclass(base, tornado.web.Application)):
+        raise RuntimeError(f"telegram.ext._updater.WebhookAppClass non trovata (PTB {telegram_version})")
+    
+    class HealthHandler(tornado.web.RequestHandler):
+        def get(self):
+            self.set_header('Content-Type', 'text/plain')
+            self.write('ok')
+    
+    class ReadyHandler(tornado.web.RequestHandler):
+        def get(self):
+            ready = is_ready(app)
+            self.set_status(200 if ready else 503)
+            self.set_header('Content-Type', 'text/plain')
+            self.write('ready' if ready else 'not ready')
+    
+    class WebhookApp(base):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.add_handlers(r'.*', [(r'/healthz', HealthHandler), (r'/readyz', ReadyHandler)])
     
-    logger.info("━━━━━━ ✅ CONTROLLO COMPLETATO ━━━━━━\n")
+    _updater.WebhookAppClass = WebhookApp
+
+async def on_startup(app: Application):
+    register_gauges()
+    dispatcher.start(app.bot)
+    if SHARD_WORKERS:
+        monitor.shards = ShardPool(SHARD_WORKERS)
+        monitor.shards.start()
+    elif PARSE_WORKERS:
+        # Con lo sharding il parsing è già fuori dal processo del bot
+        monitor.fetcher.start_parse_pool(PARSE_WORKERS)
+    app.bot_data['scheduler_task'] = asyncio.create_task(run_scheduler())
+    app.bot_data['flusher_task'] = asyncio.create_task(monitor.run_flusher())
+    if METRICS_PORT:
+        app.bot_data['metrics_server'] = await serve_metrics(METRICS_HOST, METRICS_PORT, ready=lambda: is_ready(app))
+
+async def on_shutdown(app: Application):
+    for name in ('scheduler_task', 'flusher_task'):
+        task = app.bot_data.get(name)
+        if task:
+            task.cancel()
+            # Il flusher va aspettato: un suo flush a metà rimette il blocco in _dirty
+            with suppress(asyncio.CancelledError):
+                await task
+    server = app.bot_data.get('metrics_server')
+    if server:
+        server.close()
+    await dispatcher.stop()
+    if monitor.shards:
+        await monitor.shards.stop()
+    monitor.fetcher.stop_parse_pool()
+    await monitor.close()
+    # Tutto quello che è ancora in memoria va su disco prima di uscire
+    await monitor.flush()
+    monitor.store.close()
 
 def main():
     TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
@@ -613,25 +2946,51 @@ def main():
         logger.error("❌ TELEGRAM_BOT_TOKEN mancante!")
         return
     
-    app = Application.builder().token(TOKEN).build()
+    app = (
+        Application.builder()
+        .token(TOKEN)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("aggiungi", aggiungi))
     app.add_handler(CommandHandler("lista", lista))
     app.add_handler(CommandHandler("test", test_link))
     app.add_handler(CommandHandler("rimuovi", rimuovi))
+    app.add_handler(CommandHandler("adattivo", adattivo))
+    app.add_handler(CommandHandler("filtri", filtri))
+    app.add_handler(CommandHandler("stats", stats))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     app.add_handler(CallbackQueryHandler(button_callback))
     
-    # Controllo ogni 1 MINUTO (il bot controllerà ogni link in base al suo intervallo)
-    app.job_queue.run_repeating(check_updates, interval=60, first=10)
-    
     logger.info("━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━")
     logger.info("🚀 BOT VINTED AVVIATO!")
     logger.info("⏱️  Controllo personalizzato per ogni link")
     logger.info("━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━")
     
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        # Update spinti da Telegram: niente long polling e traffico zero da fermo
+        try:
+            install_webhook_routes(app)
+        except ImportError:
+            logger.error("❌ WEBHOOK_URL richiede python-telegram-bot[webhooks] (tornado)")
+            return
+        except RuntimeError as e:
+            logger.error(f"❌ Route di salute del webhook non installabili: {e}")
+            return
+        logger.info(f"🪝 Webhook su {WEBHOOK_URL}/{WEBHOOK_PATH} (porta {WEBHOOK_PORT})")
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET or hashlib.sha256(TOKEN.encode()).hexdigest(),
+            allowed_updates=ALLOWED_UPDATES,
+        )
+    else:
+        app.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == '__main__':
     main()
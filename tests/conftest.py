@@ -0,0 +1,4 @@
+import os
+
+# bot crea monitor e database all'import: niente file su disco nei test
+os.environ.setdefault('DB_FILE', ':memory:')
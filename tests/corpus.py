@@ -0,0 +1,83 @@
+"""Corpus di riferimento per i test di parsing (usato anche da benchmark.py per i tempi)"""
+import re
+
+
+# Corpus di riferimento per extract_price: il risultato deve restare quello
+# della vecchia implementazione a nove pattern
+PRICE_GOLDEN = [
+    '€250.00', '€ 250,00', '250.00€', '250,00 €', '12 €', '12€ spedizione inclusa',
+    '250.00 EUR', '250 eur', 'EUR 250.00', 'EUR12', 'Price: 250.00', 'price 18,5',
+    'Prezzo: 250,00', 'prezzo 7', 'Costa: 30', 'costo 12,90', '250 euro', '15 Euro trattabili',
+    'include 5,70', '14,00 € 15,40 € include la Protezione acquisti',
+    'Nintendo Switch Lite, condizioni: Ottime, 120,00 €, 126,70 € include la Protezione acquisti',
+    'Felpa Nike M Ottime 18,00 € 19,60 € include la Protezione acquisti',
+    'Taglia 42 Scarpe 35 €', 'iPhone 11 64GB 200€', '10 € 20 €', '€ 5 10 €', '€10 20€',
+    'Spedizione 2,99 €\nArticolo 45,00 €', '3 x 5€', 'Nuovo con cartellino',
+    '0 €', '0,00 €', '100000 €', '€0.01', '99999 €', 'Regalo', '',
+    'include', 'include la protezione', 'Prezzo: gratis', '€ €', '2 pezzi a 8€ l\'uno',
+    'EUR 1', 'euro 5', '5euro', 'Costa 3,50 EUR include 4,20',
+    'Articolo ' * 200 + '25,00 € 27,00 € include la Protezione acquisti',
+]
+
+# Formati europei che la vecchia implementazione sbagliava
+PRICE_EUROPEAN = {
+    '1.234,56 €': '1234.56',
+    '€ 1.250': '1250.00',
+    '1.250 € include 1.320,75': '1320.75',
+    '1\u202f234,56 €': '1234.56',
+    'EUR 2.499,00': '2499.00',
+    '1,234.56 €': '1234.56',
+    'Prezzo: 1.234.': '1234.00',
+}
+
+
+def legacy_extract_price(text):
+    """La vecchia extract_price, tenuta qui solo come riferimento"""
+    text = text.replace('\n', ' ').replace('\r', ' ')
+    patterns = [
+        r'€\s*(\d+[,.]?\d*)', r'(\d+[,.]?\d*)\s*€', r'(\d+[,.]?\d*)\s*EUR', r'EUR\s*(\d+[,.]?\d*)',
+        r'[Pp]rice[:\s]+(\d+[,.]?\d*)', r'[Pp]rezzo[:\s]+(\d+[,.]?\d*)', r'[Cc]ost[oa][:\s]+(\d+[,.]?\d*)',
+        r'(\d+[,.]?\d*)\s*euro', r'include.*?(\d+[,.]?\d*)',
+    ]
+    all_prices = []
+    for pattern in patterns:
+        for match in re.finditer(pattern, text, re.IGNORECASE):
+            try:
+                price_val = float(match.group(1).replace(',', '.'))
+                if 0.01 <= price_val <= 99999:
+                    all_prices.append(price_val)
+            except ValueError:
+                continue
+    return f"{max(all_prices):.2f}" if all_prices else None
+
+
+# Card HTML difficili per l'estrazione senza JSON: il backend lxml deve dare
+# gli stessi articoli del parsing originale con BeautifulSoup
+CARD_CORPUS = [
+    # titolo solo in un <p> interno, link con testo numerico, prezzo spezzato
+    '<div class="box"><a href="/items/101-x">12</a><div><p>Giacca invernale imbottita</p>'
+    '<span>45</span><span>€</span></div></div>',
+    # commento in mezzo al testo
+    '<div><!-- promo -->Spedizione<a href="/items/102" title="Scarpe da corsa Asics">x</a> 30,00 €</div>',
+    # immagine lazy con placeholder
+    '<div><a href="/items/103" title="Borsa a tracolla">b</a>'
+    '<img src="https://static/placeholder.png" data-src="https://img/103.jpg"></div>',
+    # descrizione con classe e titolo h3
+    '<article><h3>Felpa con cappuccio 19 €</h3><a href="https://www.vinted.it/items/104-felpa">f</a>'
+    '<div class="ItemBox-Description">Come nuova, include 2,50 di spedizione</div></article>',
+    # prezzo solo nell'attributo data-testid
+    '<li><a href="/items/105">Orologio da polso vintage</a><span data-testid="item-Price">prezzo 80</span></li>',
+    # link fuori da div/article/li
+    '<p><a href="/items/106" title="Lampada da tavolo">l</a> 15 €</p>',
+    # stesso articolo due volte
+    '<div><a href="/items/107" title="Zaino da trekking">z</a><a href="/items/107">z</a> 22,00 €</div>',
+    # candidato titolo che sembra un prezzo, poi quello giusto
+    '<div><a href="/items/108">8</a><span>12,00 € spedizione inclusa</span><div><span>Maglione di cachemire grigio</span></div></div>',
+    # card annidate
+    '<div class="grid"><div class="cell"><div class="inner"><a href="/items/109" title="Cappello di paglia">c</a>'
+    '<img src="data:image/gif;base64,AAA" data-lazy-src="https://img/109.jpg"></div><p>9,99 €</p></div></div>',
+    # prezzo europeo con migliaia
+    '<div><a href="/items/110" title="Bicicletta da corsa in carbonio">b</a><span>1.250,00 €</span></div>',
+    # niente titolo né prezzo: scartato
+    '<div><a href="/items/111">1</a></div>',
+]
@@ -0,0 +1,33 @@
+import math
+
+import pytest
+
+import benchmark
+import bot
+
+
+@pytest.mark.parametrize('variant', ['json', 'html', 'api'])
+def test_standin_catalog_parses_to_newest_ids(variant):
+    # Il conteggio dei rilevati del benchmark load si basa su questi id
+    search, visible = 3, 40
+    items = benchmark.standin_items(search, visible, 30)
+    if variant == 'api':
+        body = benchmark.render_catalog_api(items[:bot.API_PER_PAGE]).encode()
+        parsed = bot.CatalogParser().parse_api(body)
+    else:
+        parsed = bot.CatalogParser().parse(benchmark.render_catalog_page(items, variant == 'json'))
+    expected = [benchmark._item_id(search, k) for k in range(visible - 1, visible - 26, -1)]
+    assert [int(item['id']) for item in parsed] == expected
+
+
+@pytest.mark.parametrize('k', [0, 7, 123])
+def test_published_at_is_when_item_becomes_visible(k):
+    t0, period, search = 1000.0, 30.0, 5
+    published = benchmark._published_at(benchmark._item_id(search, k), t0, period)
+
+    def visible(t):
+        # Stessa formula del catalogo finto
+        return math.floor((t - t0) / period + benchmark._search_phase(search))
+
+    assert visible(published - 0.01) == k
+    assert visible(published + 0.01) == k + 1
@@ -0,0 +1,52 @@
+import pytest
+
+import bot
+
+SEARCH = 'https://www.vinted.it/catalog?search_text=nike'
+ITEMS = [
+    {'id': '1', 'title': 'Nike Air Max 90', 'price': '80,00', 'currency': '€',
+     'url': 'https://www.vinted.it/items/1', 'photo': 'https://img/1.jpg'},
+    {'id': '2', 'title': 'Nike Air Force 1 rotto', 'price': '30,00', 'currency': '€',
+     'url': 'https://www.vinted.it/items/2', 'photo': 'https://img/2.jpg'},
+]
+
+
+@pytest.fixture
+def monitor():
+    return bot.VintedMonitor()
+
+
+def _link(monitor, user_id, rules):
+    link_id = monitor.add_user_link(user_id, SEARCH, f'utente {user_id}', 600)
+    monitor.set_filters(user_id, link_id, rules)
+    return link_id
+
+
+def _filter(monitor, user_id, link_id, digest='d1'):
+    link_data = monitor.get_user_links(user_id)[link_id]
+    return [item['id'] for item in monitor.filter_items(str(user_id), link_id, link_data, ITEMS, digest)]
+
+
+def test_overlapping_keywords_of_other_subscribers_do_not_hide_matches(monitor):
+    a = _link(monitor, 1, {'include': ['nike air']})
+    b = _link(monitor, 2, {'exclude': ['air max']})
+    assert _filter(monitor, 1, a) == ['1', '2']
+    assert _filter(monitor, 2, b) == ['2']
+
+
+def test_new_keywords_are_not_checked_against_stale_features(monitor):
+    a = _link(monitor, 1, {'exclude': ['rotto']})
+    assert _filter(monitor, 1, a) == ['1']
+    # Stesso risultato (digest d1), ma ora la ricerca ha una parola chiave in più
+    b = _link(monitor, 2, {'include': ['max']})
+    assert _filter(monitor, 2, b) == ['1']
+    assert _filter(monitor, 1, a) == ['1']
+
+
+def test_removed_link_keywords_leave_the_search(monitor):
+    a = _link(monitor, 1, {'include': ['nike air']})
+    b = _link(monitor, 2, {'exclude': ['air max']})
+    _filter(monitor, 1, a)
+    monitor.remove_user_link(1, a)
+    assert monitor._keyword_re(bot.normalize_vinted_url(SEARCH))[1] == {'air max'}
+    assert _filter(monitor, 2, b) == ['2']
@@ -0,0 +1,33 @@
+import pytest
+
+import bot
+from tests.corpus import CARD_CORPUS, PRICE_GOLDEN, PRICE_EUROPEAN, legacy_extract_price
+
+
+def _short(text):
+    return repr(text[:40])
+
+
+@pytest.fixture(scope='module')
+def parser():
+    return bot.CatalogParser()
+
+
+@pytest.mark.parametrize('text', PRICE_GOLDEN, ids=_short)
+def test_price_matches_legacy(parser, text):
+    assert parser.extract_price(text) == legacy_extract_price(text)
+
+
+@pytest.mark.parametrize('text, expected', PRICE_EUROPEAN.items(), ids=_short)
+def test_price_european_formats(parser, text, expected):
+    assert parser.extract_price(text) == expected
+
+
+@pytest.mark.skipif(bot.lxml_html is None, reason='lxml non installato')
+def test_lxml_cards_match_html_parser():
+    page = '<html><body>' + ''.join(CARD_CORPUS) + '</body></html>'
+    old = bot.CatalogParser('html.parser')._parse_bs4(page, 'catalog')
+    new = bot.CatalogParser('lxml')._parse_lxml(page, 'catalog')
+    assert new == old
+    # L'ultima card non ha né titolo né prezzo
+    assert len(new) == len(CARD_CORPUS) - 1
@@ -0,0 +1,40 @@
+import json
+import sys
+
+import bot
+
+
+def _snapshot(count=25, start=4_000_000_000):
+    """Il vecchio last_items: gli articoli interi dell'ultimo check"""
+    return [{'id': str(start + i), 'title': f'Felpa Nike vintage taglia M #{i}', 'price': '18.50',
+             'currency': '€', 'url': f'https://www.vinted.it/items/{start + i}-felpa-nike-vintage',
+             'photo': f'https://images1.vinted.net/t/{start + i}/f800/1700000000.jpeg?s=abcdef0123456789'}
+            for i in range(count)]
+
+
+def _deep_size(items):
+    return sys.getsizeof(items) + sum(
+        sys.getsizeof(item) + sum(sys.getsizeof(v) for v in item.values()) for item in items)
+
+
+def test_keeps_most_recent_ids_up_to_limit():
+    seen = bot.SeenIds(limit=3)
+    seen.add_many(['1', '2', '3', '2', '4'])
+    assert list(seen.ids) == [2, 3, 4]
+    assert '1' not in seen and '4' in seen
+    items = [{'id': '4'}, {'id': '5'}, {'id': 'abc'}]
+    assert [i['id'] for i in seen.new_items(items)] == ['5', 'abc']
+    # Salvato con un limite più alto, ricaricato con uno più basso
+    assert list(bot.SeenIds(seen.encode(), limit=2).ids) == [3, 4]
+
+
+def test_full_index_is_smaller_than_old_snapshot():
+    seen = bot.SeenIds()
+    seen.add_many(4_000_000_000 + i for i in range(10 * bot.SEEN_IDS_LIMIT))
+    assert len(seen) == bot.SEEN_IDS_LIMIT
+    encoded = seen.encode()
+    old = _snapshot()
+    # Su disco: stringa base64 contro il JSON degli articoli
+    assert len(encoded) < len(json.dumps(old)) / 2
+    # In memoria: array più stringa tenuta in link_data, contro i dict interi
+    assert sys.getsizeof(seen.ids) + sys.getsizeof(encoded) < _deep_size(old) / 2